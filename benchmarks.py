@@ -0,0 +1,222 @@
+"""
+Throughput benchmarks for propagation, visibility and the solvers.
+
+    python benchmarks.py --output bench.json
+    python benchmarks.py --quick --compare bench.json
+
+Every result is a record with the benchmark name, batch and constellation sizes, best time over the repeats,
+the rate in items per second and the peak memory allocated during one run, and for the batch solvers the mean
+number of iterations per fix, so a convergence regression shows up next to the speed. Results are written as JSON
+together with the commit, python and numpy versions, so runs from different commits can be compared with --compare.
+"""
+import argparse
+import json
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+from datetime import datetime, timezone, timedelta
+from math import radians
+
+from earth import Earth
+from translations import spherical_to_rectangular
+from satellites import Constellation
+from utils import minutes_since_spring_equinox
+from tasks import transit_sats, gps_sats, all_constellation, get_visible_satellites, get_visible_satellites_batch, \
+    rho_rho2, rho_rho3, rho_rho2_batch, rho_rho3_batch, doppler, get_transition_matrix
+
+
+def random_constellation(size, seed=0):
+    """
+    :param size: int - number of satellites, half of them on Transit orbits and half on GPS ones
+    :return: Constellation with random ascending nodes and times of passing them
+    """
+    rng = np.random.default_rng(seed)
+    transit = np.arange(size) % 2 == 0
+    return Constellation(rng.uniform(0, 2*np.pi, size), rng.uniform(0, 180, size),
+                         np.where(transit, radians(90), radians(60)),
+                         np.where(transit, 7500, 15000),
+                         np.where(transit, radians(3), radians(2)))
+
+
+def measure(function, repeat):
+    """
+    :param function: callable without arguments
+    :param repeat: int - number of timed runs
+    :return: (best time in seconds, peak memory in bytes allocated during an extra run, what that run returned)
+    """
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter() - start)
+
+    tracemalloc.start()
+    value = function()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return best, peak, value
+
+
+def _ranges_problem(batch, rng):
+    # fixes around the rho_rho3 test case: noisy satellites and the distances from noisy true positions
+    satellites = np.array([[8639.76, -2477.41, 4383.71],
+                           [9174.33, 2287.42, -3255.68],
+                           [8974.15, -3444.85, 2756.37]]) + rng.normal(0, 100, (batch, 3, 3))
+    real = np.column_stack([np.full(batch, 7000.), np.radians(rng.uniform(0, 2, (batch, 2)))])
+    distances = np.linalg.norm(satellites - spherical_to_rectangular(real)[:, np.newaxis], axis=-1)
+    guess = np.tile([7000, radians(1), radians(-1)], (batch, 1))
+    return guess, satellites, distances
+
+
+def _surface_problem(batch, rng):
+    # rho_rho2 keeps the position on the Earth surface: true positions there, guesses within a degree of them
+    satellites = np.array([[8676.21, -2487.86, 4305.11],
+                           [9146.41, 2280.46, -3338.07]]) + rng.normal(0, 100, (batch, 2, 3))
+    real = np.radians(rng.uniform(0, 2, (batch, 2)))
+    real_cds = spherical_to_rectangular(np.insert(real, 0, Earth.R, axis=1))
+    distances = np.linalg.norm(satellites - real_cds[:, np.newaxis], axis=-1)
+    guess = real + np.radians(rng.uniform(-1, 1, (batch, 2)))
+    return guess, satellites, distances
+
+
+def _doppler_problem(constellation, minutes):
+    real = spherical_to_rectangular(np.array([Earth.R, radians(70), radians(50)]))
+    positions, speeds = constellation.coordinates_greenwich(minutes), constellation.speed_greenwich(minutes)
+    diff = real - positions
+    rho_dot_real = np.einsum('...i,...i->...', diff, -speeds)/np.linalg.norm(diff, axis=-1)
+    return positions, speeds, rho_dot_real
+
+
+def benchmarks(batch_sizes, constellation_sizes):
+    """
+    :return: generator of (name, unit, batch size, constellation size, number of items, function, iterations),
+        iterations gets what function returned and gives the iterations per fix, None for non-solvers
+    """
+    rng = np.random.default_rng(0)
+    msk = timezone(timedelta(hours=3))
+    when = datetime(2015, 6, 11, 23, 0, 0, 0, msk)
+    minutes0 = minutes_since_spring_equinox(when)
+
+    for sats in constellation_sizes:
+        constellation = random_constellation(sats)
+        satellite = constellation[0]
+        for batch in batch_sizes:
+            minutes = minutes0 + np.arange(batch)/60
+            yield ('coordinates_greenwich', 'states', batch, 1, batch,
+                   lambda: satellite.coordinates_greenwich(minutes), None)
+            yield ('speed_greenwich', 'states', batch, 1, batch, lambda: satellite.speed_greenwich(minutes), None)
+            yield ('Constellation.coordinates_greenwich', 'states', batch, sats, batch*sats,
+                   lambda: constellation.coordinates_greenwich(minutes), None)
+
+            where = np.radians(np.column_stack([rng.uniform(-90, 90, batch), rng.uniform(-180, 180, batch)]))
+            yield ('get_visible_satellites_batch', 'checks', batch, sats, batch*sats,
+                   lambda: get_visible_satellites_batch(where, [when], constellation), None)
+
+    # batch solvers return (positions, iterations)
+    batch_iterations = lambda value: value[1]
+    for batch in batch_sizes:
+        guess, satellites, distances = _ranges_problem(batch, rng)
+        yield ('rho_rho3_batch', 'fixes', batch, 3, batch, lambda: rho_rho3_batch(guess, satellites, distances),
+               batch_iterations)
+        guess2, satellites2, distances2 = _surface_problem(batch, rng)
+        yield ('rho_rho2_batch', 'fixes', batch, 2, batch, lambda: rho_rho2_batch(guess2, satellites2, distances2),
+               batch_iterations)
+
+    # scalar entry points, one call per item, on the test cases from tests.py
+    scalar = min(batch_sizes)
+    where = np.radians([85, 20])
+    yield ('get_visible_satellites', 'calls', scalar, len(all_constellation), scalar,
+           lambda: [get_visible_satellites(where, when) for _ in range(scalar)], None)
+
+    position = np.radians([0.5, -1])
+    satellites2 = np.array([[8676.21, -2487.86, 4305.11], [9146.41, 2280.46, -3338.07]])
+    distances2 = np.array([5339.75, 5101.44])
+    yield ('rho_rho2', 'fixes', scalar, 2, scalar,
+           lambda: [rho_rho2(np.copy(position), satellites2, distances2) for _ in range(scalar)], None)
+
+    guess, satellites, distances = _ranges_problem(scalar, rng)
+    yield ('rho_rho3', 'fixes', scalar, 3, scalar,
+           lambda: [rho_rho3(np.copy(guess[k]), satellites[k], distances[k]) for k in range(scalar)], None)
+
+    selected = Constellation.from_satellites([gps_sats[1], gps_sats[2], transit_sats[2], transit_sats[3]])
+    positions, speeds, rho_dot_real = _doppler_problem(selected, minutes0)
+    ipoint_sph = np.array([Earth.R, radians(61.5), radians(57.5)])
+    yield ('doppler', 'fixes', scalar, len(selected), scalar,
+           lambda: [doppler(ipoint_sph, np.zeros(3), positions, speeds, rho_dot_real) for _ in range(scalar)], None)
+
+    coords = np.radians([-1, 1])
+    satellites2 = np.array([[8864.09, -2210.07, 4067.37], [8974.15, 2573.3, -3583.68]])
+    dist_real = np.array([[5466.72, 4992.39], [5510.15, 4955.85]])
+    yield ('get_transition_matrix', 'calls', scalar, 2, scalar,
+           lambda: [get_transition_matrix(coords, satellites2, dist_real) for _ in range(scalar)], None)
+
+
+def run(batch_sizes=(100, 10000), constellation_sizes=(12, 48), repeat=3):
+    """
+    :return: list of result records, see the module docstring
+    """
+    results = []
+    for name, unit, batch, sats, items, function, iterations in benchmarks(batch_sizes, constellation_sizes):
+        seconds, peak, value = measure(function, repeat)
+        results.append({'name': name, 'unit': unit, 'batch_size': batch, 'constellation_size': sats,
+                        'seconds': seconds, 'rate': items/seconds, 'peak_memory': peak,
+                        'mean_iterations': None if iterations is None else float(np.mean(iterations(value)))})
+    return results
+
+
+def environment():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True).stdout.strip()
+    except OSError:
+        commit = None
+    return {'commit': commit or None, 'python': platform.python_version(), 'numpy': np.__version__,
+            'machine': platform.machine(), 'time': time.strftime('%Y-%m-%dT%H:%M:%S')}
+
+
+def compare(old, new):
+    """
+    :param old: results list of an earlier run
+    :param new: results list of this run
+    :return: [(name, batch size, constellation size, new rate / old rate), ...] for benchmarks present in both
+    """
+    key = lambda result: (result['name'], result['batch_size'], result['constellation_size'])
+    old = {key(result): result for result in old}
+    return [key(result) + (result['rate']/old[key(result)]['rate'],) for result in new if key(result) in old]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--output', help='JSON file to write the results to')
+    parser.add_argument('--compare', help='JSON file of an earlier run to compare the rates with')
+    parser.add_argument('--quick', action='store_true', help='small batches and a single repeat')
+    args = parser.parse_args(argv)
+
+    if args.quick:
+        results = run(batch_sizes=(10, 1000), constellation_sizes=(12,), repeat=1)
+    else:
+        results = run()
+
+    for result in results:
+        iterations = result.get('mean_iterations')
+        print('{name:40} batch {batch_size:>6} sats {constellation_size:>3}  {rate:14.1f} {unit}/s  '
+              '{peak_memory:>10} B'.format(**result) + ('' if iterations is None else '  {:.2f} it'.format(iterations)))
+
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump({'environment': environment(), 'results': results}, output, indent=1)
+
+    if args.compare:
+        with open(args.compare) as previous:
+            previous = json.load(previous)
+        print('\nRates relative to', previous['environment'].get('commit'))
+        for name, batch, sats, ratio in compare(previous['results'], results):
+            print('{:40} batch {:>6} sats {:>3}  x{:.2f}'.format(name, batch, sats, ratio))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,119 @@
+import numpy as np
+from math import sin, cos
+
+from earth import Earth
+from translations import rectangular_to_spherical
+from utils import GroundStation, minutes_since_spring_equinox
+import registry
+
+
+def _ranges(starts, stops):
+    """
+    :return: numpy.array - concatenation of arange(start, stop) for every pair, without a python loop
+    """
+    lengths = stops - starts
+    return np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+
+
+class CoverageIndex:
+    """
+    Observers on the Earth surface binned into latitude-longitude cells, answering which of them see a satellite.
+    A surface observer sees a satellite at distance |s| from the Earth center only within the spherical cap of
+    half-angle arccos(Earth.R/|s|) around the sub-satellite point, so only the cells overlapping that cap are read
+    and sat_really_visible criterion is checked for the observers found there.
+    Observers are stored sorted by cell, cell k holding rows offsets[k]:offsets[k + 1], so every latitude band of
+    the cap is at most two contiguous slices.
+    """
+
+    def __init__(self, where, cell=np.radians(1)):
+        """
+        :param where: [[psi, lam], ...] radians - observers spherical coordinates, shape (N, 2)
+        :param cell: radians - cells size in latitude and longitude, shrunk to the nearest divisor of 360 degrees
+        """
+        where = np.asarray(where, dtype=float).reshape(-1, 2)
+        # equal columns, otherwise the last one is narrower and the wrap in _candidates misses column 0
+        self.columns = int(np.ceil(2*np.pi/cell))
+        self.cell = 2*np.pi/self.columns
+        self.bands = int(np.ceil(np.pi/self.cell))
+
+        cells = self._band(where[:, 0])*self.columns + self._column(where[:, 1])
+        # observer indices in cell order, stations row k is observer ids[k]
+        self.ids = np.argsort(cells, kind='stable')
+        self.stations = GroundStation(where[self.ids])
+        self.offsets = np.concatenate([[0], np.cumsum(np.bincount(cells, minlength=self.bands*self.columns))])
+
+    def __len__(self):
+        return len(self.ids)
+
+    def _band(self, psi):
+        return np.clip(np.floor((psi + np.pi/2)/self.cell).astype(int), 0, self.bands - 1)
+
+    def _column(self, lam):
+        return np.floor((lam + np.pi)/self.cell).astype(int) % self.columns
+
+    def _candidates(self, sat_cds):
+        """
+        :param sat_cds: [x, y, z] - satellite greenwich coordinates
+        :return: numpy.array - rows of stations inside the cells overlapping the satellite visibility cap
+        """
+        distance, psi, lam = rectangular_to_spherical(sat_cds)
+        # a little wider than the cap, the exact check follows anyway
+        alpha = np.arccos(min(1, Earth.R/distance)) + 1e-9
+
+        bands = np.arange(self._band(psi - alpha), self._band(psi + alpha) + 1)
+        if abs(sin(psi)) >= cos(alpha):
+            # the cap covers a pole, all longitudes
+            half_width = np.full(len(bands), np.pi)
+        else:
+            # the cap is widest in longitude at the latitude it touches a meridian at, otherwise at the band edge
+            # closest to it: cos(dlam) = (cos(alpha) - sin(phi)*sin(psi))/(cos(phi)*cos(psi))
+            phi = np.clip(np.arcsin(sin(psi)/cos(alpha)), bands*self.cell - np.pi/2, (bands + 1)*self.cell - np.pi/2)
+            cos_width = (cos(alpha) - np.sin(phi)*sin(psi))/(np.maximum(np.cos(phi), 1e-12)*cos(psi))
+            half_width = np.arccos(np.clip(cos_width, -1, 1))
+
+        first = np.floor((lam - half_width + np.pi)/self.cell).astype(int)
+        last = np.floor((lam + half_width + np.pi)/self.cell).astype(int)
+        whole = last - first + 1 >= self.columns
+        first, last = np.where(whole, 0, first), np.where(whole, self.columns - 1, last)
+
+        # a range crossing the -180/180 meridian is split in two
+        wrapped = ~whole & ((first < 0) | (last >= self.columns))
+        first, last = first % self.columns, last % self.columns
+        row = bands*self.columns
+        starts = np.concatenate([row + first, row[wrapped]])
+        stops = np.concatenate([row + np.where(wrapped, self.columns - 1, last), row[wrapped] + last[wrapped]]) + 1
+        return _ranges(self.offsets[starts], self.offsets[stops])
+
+    def observers_seeing(self, sat_cds):
+        """
+        :param sat_cds: [x, y, z] - satellite greenwich coordinates
+        :return: numpy.array - sorted indices of the observers the satellite is visible from
+        """
+        sat_cds = np.asarray(sat_cds, dtype=float)
+        rows = self._candidates(sat_cds)
+        # the same expression sats_really_visible evaluates, so both agree on every pair
+        dot = self.stations.position[rows].dot(sat_cds)
+        norm2, sat_norm2 = self.stations.norm2[rows], sat_cds.dot(sat_cds)
+        left = (dot - norm2)/np.sqrt(sat_norm2*np.maximum(sat_norm2 - 2*dot + norm2, 0))
+        return np.sort(self.ids[rows[left > self.stations.horizon[rows]]])
+
+    def query(self, when, constellation=None):
+        """
+        :param when: datetime.datetime with timezone, or anything else minutes_since_spring_equinox accepts for one
+            time
+        :param constellation: Constellation, all_constellation by default
+        :return: [numpy.array, ...] - observers_seeing for every satellite of the constellation
+        """
+        if constellation is None:
+            constellation = registry.get('all')
+        sats_cds = constellation.coordinates_greenwich(minutes_since_spring_equinox(when))
+        return [self.observers_seeing(sat_cds) for sat_cds in sats_cds]
+
+    def covered(self, when, constellation=None):
+        """
+        :return: int numpy.array of shape (N,) - number of satellites visible from every observer, see query
+        """
+        counts = np.zeros(len(self), dtype=int)
+        for observers in self.query(when, constellation):
+            counts[observers] += 1
+        return counts
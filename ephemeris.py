@@ -0,0 +1,128 @@
+import numpy as np
+
+from translations import earth_rotation
+from satellites import Satellite, Constellation
+from storage import save_columns, load_columns
+
+
+class EphemerisTable:
+    """
+    Equatorial positions and speeds of a constellation tabulated on a regular time grid. Values between grid points
+    come from cubic Hermite interpolation, which uses both the tabulated positions and speeds.
+
+    Error bound: on a step h cubic Hermite interpolation is off by at most h^4/384 * max|f''''|. On a circular
+    orbit |x''''| = R*w^4 and |v''''| = R*w^5, so the position error is below R*w^4*h^4/384 and the speed error is
+    below R*w^5*h^4/384. For the default one minute step that is 0.15 m and 0.008 m/min for Transit satellites,
+    0.06 m and 0.002 m/min for GPS ones.
+    """
+
+    def __init__(self, positions, speeds, w, start, step):
+        """
+        :param positions: numpy.array of shape (S, N, 3) km - equatorial positions at start + k*step
+        :param speeds: numpy.array of shape (S, N, 3) km/min - equatorial speeds at the same times
+        :param w: numpy.array of shape (S,) radians/min - angular speeds, give the accelerations -w^2*position
+        :param start: minutes - time of the first grid point
+        :param step: minutes - grid step
+        """
+        self.positions, self.speeds = positions, speeds
+        self.w = np.asarray(w, dtype=float)
+        self.start, self.step = float(start), float(step)
+        self.stop = self.start + self.step*(positions.shape[1] - 1)
+
+    @classmethod
+    def build(cls, constellation, start, stop, step=1.0):
+        """
+        :param constellation: Constellation, or a single Satellite
+        :param start: minutes - beginning of the tabulated span
+        :param stop: minutes - end of the tabulated span, included
+        :param step: minutes - grid step
+        :return: EphemerisTable covering [start, stop]
+        """
+        if isinstance(constellation, Satellite):
+            constellation = Constellation.from_satellites([constellation])
+        minutes = start + step*np.arange(int(np.ceil((stop - start)/step)) + 1)
+        return cls(constellation.coordinates_equatorial(minutes), constellation.speed_equatorial(minutes),
+                   constellation.w, start, step)
+
+    def __len__(self):
+        return len(self.w)
+
+    def _locate(self, minutes):
+        minutes = np.asarray(minutes, dtype=float)
+        if np.any(minutes < self.start) or np.any(minutes > self.stop):
+            raise ValueError("minutes outside of the tabulated span [{}, {}]".format(self.start, self.stop))
+
+        position = (minutes - self.start)/self.step
+        k = np.minimum(position.astype(int), self.positions.shape[1] - 2)
+        return k, position - k
+
+    def _hermite(self, values, derivatives, k, s):
+        """
+        :param values: numpy.array of shape (S, N, 3) - tabulated function
+        :param derivatives: callable (indices) -> numpy.array of shape (S, ..., 3), derivative at grid points
+        :param k: numpy.array of grid intervals
+        :param s: numpy.array of positions within the intervals, 0 <= s <= 1
+        :return: numpy.array of shape (S,) + k.shape + (3,)
+        """
+        if not np.any(s):
+            # whole grid points, e.g. minutes_since_spring_equinox results on a one minute grid
+            return values[:, k]
+
+        s = s[..., np.newaxis]
+        s2 = s*s
+        h00, h01 = 1 + s2*(2*s - 3), s2*(3 - 2*s)
+        h10, h11 = self.step*s*(s - 1)**2, self.step*s2*(s - 1)
+        return h00*values[:, k] + h01*values[:, k + 1] + h10*derivatives(k) + h11*derivatives(k + 1)
+
+    def _accelerations(self, k):
+        # speeds of the speeds: on a circular orbit acceleration is -w^2*position
+        w2 = (self.w**2).reshape((-1,) + (1,)*(np.ndim(k) + 1))
+        return -w2*self.positions[:, k]
+
+    def coordinates_equatorial(self, minutes):
+        """
+        :param minutes: scalar or numpy.array of shape (T,) - minutes since spring equinox, within [start, stop]
+        :return: numpy.array of shape (S, 3), or (S, T, 3) for an array of times
+        """
+        k, s = self._locate(minutes)
+        return self._hermite(self.positions, lambda indices: self.speeds[:, indices], k, s)
+
+    def speed_equatorial(self, minutes):
+        """
+        :param minutes: scalar or numpy.array of shape (T,) - minutes since spring equinox, within [start, stop]
+        :return: numpy.array of shape (S, 3), or (S, T, 3) for an array of times
+        """
+        k, s = self._locate(minutes)
+        return self._hermite(self.speeds, self._accelerations, k, s)
+
+    def coordinates_greenwich(self, minutes):
+        return earth_rotation(minutes).to_greenwich(self.coordinates_equatorial(minutes))
+
+    def speed_greenwich(self, minutes):
+        return earth_rotation(minutes).to_equatorial(self.speed_equatorial(minutes))
+
+    def states_greenwich(self, minutes):
+        """
+        :return: (coordinates_greenwich(minutes), speed_greenwich(minutes)), the cell of every time is located once
+        """
+        k, s = self._locate(minutes)
+        rotation = earth_rotation(minutes)
+        return (rotation.to_greenwich(self._hermite(self.positions, lambda indices: self.speeds[:, indices], k, s)),
+                rotation.to_equatorial(self._hermite(self.speeds, self._accelerations, k, s)))
+
+    def save(self, path):
+        """
+        :param path: directory to write the 'ephemeris' dataset to, see storage.py
+        """
+        save_columns(path, 'ephemeris', {'start': self.start, 'step': self.step, 'w': self.w.tolist()},
+                     positions=self.positions, speeds=self.speeds)
+
+    @classmethod
+    def load(cls, path, mmap_mode='r'):
+        """
+        :param path: directory written by save
+        :param mmap_mode: passed to numpy.load, 'r' maps the tables instead of reading them, None reads them
+        :return: EphemerisTable
+        """
+        columns, meta = load_columns(path, mmap_mode)
+        return cls(columns['positions'], columns['speeds'], meta['w'], meta['start'], meta['step'])
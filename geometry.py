@@ -0,0 +1,113 @@
+from functools import lru_cache
+from itertools import combinations
+
+import numpy as np
+
+from utils import range_residuals, rho_dot_residuals
+
+
+def range_jacobian(position, sats_cds):
+    """
+    :param position: numpy.array of shape (..., 3) - [x, y, z]
+    :param sats_cds: numpy.array of shape (..., K, 3) - satellites rectangular coordinates
+    :return: numpy.array of shape (..., K, 3) - distance_derivative rows, unit vectors from satellites to position
+    """
+    position = np.asarray(position, dtype=float)
+    sats_cds = np.asarray(sats_cds, dtype=float)
+    shape = np.broadcast_shapes(position.shape[:-1] + (1, 3), sats_cds.shape)
+    return range_residuals(position, sats_cds, 0, np.empty(shape), np.empty(shape[:-1]), np.empty(shape))[1]
+
+
+def doppler_jacobian(position, speed, sats_positions, sats_speeds):
+    """
+    :param position: numpy.array of shape (..., 3) - [x, y, z]
+    :param speed: numpy.array of shape (..., 3) - position speed
+    :param sats_positions: numpy.array of shape (..., K, 3) - satellites greenwich coordinates
+    :param sats_speeds: numpy.array of shape (..., K, 3) - satellites greenwich speeds
+    :return: numpy.array of shape (..., K, 3) - rho_dot_derivative rows
+    """
+    position = np.asarray(position, dtype=float)
+    sats_positions = np.asarray(sats_positions, dtype=float)
+    shape = np.broadcast_shapes(position.shape[:-1] + (1, 3), sats_positions.shape)
+    return rho_dot_residuals(position, np.asarray(speed, dtype=float), sats_positions,
+                             np.asarray(sats_speeds, dtype=float), 0, np.empty(shape), np.empty(shape),
+                             np.empty(shape[:-1]), np.empty(shape[:-1]), np.empty(shape))[1]
+
+
+def dilution_of_precision(jacobian, weights=None):
+    """
+    :param jacobian: numpy.array of shape (..., K, n) - a row per measurement, the first 3 unknowns are the position
+    :param weights: numpy.array of shape (..., K) - measurement weights, equal if None
+    :return: (GDOP, PDOP) numpy.arrays of shape (...) - square roots of the trace of (H^T W H)^-1 and of its
+        position block, inf for geometries that don't determine the position
+    """
+    jacobian = np.asarray(jacobian, dtype=float)
+    weighted = jacobian if weights is None else jacobian*np.asarray(weights, dtype=float)[..., np.newaxis]
+    normal = np.einsum('...ki,...kj->...ij', weighted, jacobian)
+
+    # diagonal of the inverse from the eigen decomposition: no exception for a singular matrix in the stack
+    eigenvalues, eigenvectors = np.linalg.eigh(normal)
+    tiny = np.finfo(float).eps*np.abs(eigenvalues).max(axis=-1, keepdims=True)
+    singular = eigenvalues <= tiny
+    diagonal = np.einsum('...ij,...j->...i', eigenvectors**2, 1/np.where(singular, 1, eigenvalues))
+    # a null direction along an axis would give 0*inf = nan there, so singular stacks are marked as a whole
+    singular = singular.any(axis=-1)
+    return np.where(singular, np.inf, np.sqrt(diagonal.sum(axis=-1))), \
+        np.where(singular, np.inf, np.sqrt(diagonal[..., :3].sum(axis=-1)))
+
+
+@lru_cache(maxsize=64)
+def _combinations(count, size):
+    return np.array(list(combinations(range(count), size)), dtype=int).reshape(-1, size)
+
+
+def best_subset(jacobian, size, metric='gdop', weights=None):
+    """
+    Scores every subset of size measurements at once and picks the best conditioned one
+    :param jacobian: numpy.array of shape (K, n), K >= size >= n - a row per visible satellite
+    :param size: int - number of satellites to select
+    :param metric: 'gdop' or 'pdop'
+    :param weights: numpy.array of shape (K,) - measurement weights, equal if None
+    :return: (sorted indices of the selected rows, their dilution of precision)
+    """
+    jacobian = np.asarray(jacobian, dtype=float)
+    subsets = _combinations(len(jacobian), size)
+    gdop, pdop = dilution_of_precision(jacobian[subsets], None if weights is None else np.asarray(weights)[subsets])
+    scores = gdop if metric == 'gdop' else pdop
+    best = np.argmin(scores)
+    return subsets[best], scores[best]
+
+
+class SubsetSelector:
+    """
+    best_subset for a sequence of fixes. Satellites move little between close epochs, so while the visible set stays
+    the same the last choice is kept instead of scoring all subsets again.
+    """
+
+    def __init__(self, size=3, metric='gdop', max_age=None):
+        """
+        :param size: int - number of satellites to select
+        :param metric: 'gdop' or 'pdop'
+        :param max_age: minutes - rescore after that long even if the visible set didn't change, never if None
+        """
+        self.size, self.metric, self.max_age = size, metric, max_age
+        self._visible, self._minutes, self._choice = None, None, None
+
+    def select(self, visible, jacobian, minutes=None):
+        """
+        :param visible: [i, ...] - indices of the visible satellites, in any numbering that identifies them
+        :param jacobian: callable () -> numpy.array of shape (len(visible), n), rows in visible order, e.g. from
+            range_jacobian or doppler_jacobian. Only called when the subsets are scored
+        :param minutes: epoch of the fix, needed with max_age
+        :return: (selected subset of visible, its dilution of precision when it was scored)
+        """
+        visible = tuple(visible)
+        if visible == self._visible and (self.max_age is None or minutes - self._minutes <= self.max_age):
+            return self._choice
+
+        if len(visible) < self.size:
+            raise ValueError('{} satellites visible, {} needed'.format(len(visible), self.size))
+        rows, score = best_subset(jacobian(), self.size, self.metric)
+        self._visible, self._minutes = visible, minutes
+        self._choice = [visible[row] for row in rows], score
+        return self._choice
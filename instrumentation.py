@@ -0,0 +1,155 @@
+import time
+from collections import Counter
+
+import numpy as np
+
+from translations import rectangular_to_spherical
+
+# sink used by every instrumented function called without an explicit instrument, see attach
+_attached = None
+
+
+class Instrument:
+    """
+    Callbacks the solvers and visibility functions call while they work. All of them do nothing here, subclasses
+    override the ones they need. Instrumented functions skip the calls entirely when no instrument is in use.
+    """
+
+    def call_started(self, function):
+        """
+        :param function: str - name of the instrumented function
+        :return: anything, handed back to call_finished
+        """
+        return None
+
+    def iteration(self, function, step, dq, dq_norm, residual_norm, position):
+        """
+        :param step: int - iteration number, starting with 1
+        :param dq: numpy.array - step taken on this iteration
+        :param dq_norm: its norm
+        :param residual_norm: norm of measured - computed values at the point the step was computed at
+        :param position: solver state after the step, [psi, lam] radians or [x, y, z] km
+        The batch solvers call it once per iteration for all the fixes still iterating, dq and position then have
+        a row per fix, dq_norm and residual_norm are arrays of per-fix norms.
+        """
+
+    def event(self, function, label, value):
+        """
+        :param label: str - what value is, e.g. 'Minutes since spring equinox'
+        :param value: anything printable
+        """
+
+    def count(self, counter, value=1):
+        """
+        :param counter: str - e.g. 'visibility_checks'
+        :param value: int - increment
+        """
+
+    def call_finished(self, function, started, iterations=None, converged=None):
+        """
+        :param started: what call_started returned
+        :param iterations: int or numpy.array of per-fix counts, None for non-iterative functions
+        :param converged: bool or numpy.array of per-fix flags, None for non-iterative functions
+        """
+
+
+class PrintInstrument(Instrument):
+    """
+    Prints every iteration and event to stdout, which is what display=True does
+    """
+
+    def iteration(self, function, step, dq, dq_norm, residual_norm, position):
+        if np.shape(position)[-1] == 2:
+            position = np.degrees(position)
+        else:
+            position = rectangular_to_spherical(position)
+            position[..., 1:] = np.degrees(position[..., 1:])
+        print("Step:", step)
+        print("dq: {}, norm: {}".format(dq, dq_norm))
+        print("Position:", position, end='\n\n')
+
+    def event(self, function, label, value):
+        print(label + ':', value)
+
+
+class Summary:
+    """
+    Count, sum, minimum and maximum of the observed values, constant memory whatever the number of observations
+    """
+
+    def __init__(self):
+        self.count, self.total, self.min, self.max = 0, 0.0, float('inf'), float('-inf')
+
+    def add(self, values):
+        values = np.asarray(values, dtype=float)
+        if values.size:
+            self.count += values.size
+            self.total += float(values.sum())
+            self.min = min(self.min, float(values.min()))
+            self.max = max(self.max, float(values.max()))
+
+    def as_dict(self):
+        return {'count': self.count, 'total': self.total, 'min': self.min, 'max': self.max,
+                'mean': self.total/self.count if self.count else None}
+
+
+class MetricsSink(Instrument):
+    """
+    Aggregates counters, call timers, iteration counts, convergence and residual norms per function
+    """
+
+    def __init__(self):
+        self.counters = Counter()
+        self.summaries = {}
+
+    def _summary(self, name):
+        if name not in self.summaries:
+            self.summaries[name] = Summary()
+        return self.summaries[name]
+
+    def call_started(self, function):
+        return time.perf_counter()
+
+    def iteration(self, function, step, dq, dq_norm, residual_norm, position):
+        self._summary(function + '.residual_norm').add(residual_norm)
+        self._summary(function + '.step_norm').add(dq_norm)
+
+    def count(self, counter, value=1):
+        self.counters[counter] += value
+
+    def call_finished(self, function, started, iterations=None, converged=None):
+        self._summary(function + '.seconds').add(time.perf_counter() - started)
+        self.counters[function + '.calls'] += 1
+        if iterations is not None:
+            self._summary(function + '.iterations').add(iterations)
+        if converged is not None:
+            converged = np.asarray(converged)
+            self.counters[function + '.converged'] += int(np.count_nonzero(converged))
+            self.counters[function + '.diverged'] += int(converged.size - np.count_nonzero(converged))
+
+    def snapshot(self):
+        """
+        :return: dict of counters and summaries, JSON serializable
+        """
+        metrics = dict(self.counters)
+        metrics.update((name, summary.as_dict()) for name, summary in self.summaries.items())
+        return metrics
+
+
+def attach(sink):
+    """
+    :param sink: Instrument used by instrumented functions called without one, None to detach
+    """
+    global _attached
+    _attached = sink
+
+
+def active(instrument=None, display=False):
+    """
+    :return: instrument if given, PrintInstrument if display, the attached sink otherwise (None if there is none)
+    """
+    if instrument is not None:
+        return instrument
+    if display:
+        return PrintInstrument()
+    return _attached
@@ -0,0 +1,86 @@
+import numpy as np
+from collections import namedtuple
+
+from earth import Earth
+from translations import EarthRotation, spherical_to_rectangular
+from utils import minutes_since_spring_equinox, sats_really_visible, visibility_margin
+import registry
+
+# one row per pass, sorted by observer, satellite and rise. rise and set are minutes since the spring equinox of
+# start, clipped to the predicted span, so a pass in progress at its start or end begins or ends right there
+Passes = namedtuple('Passes', ['observer', 'satellite', 'rise', 'set'])
+
+
+def _coordinates_greenwich(constellation, sats, minutes):
+    """
+    :return: numpy.array of shape (K, 3) - satellite sats[k] at minutes[k], see Constellation.coordinates_equatorial
+    """
+    # bisection midpoints never repeat, so the rotation isn't taken from the cache
+    return EarthRotation(minutes).to_greenwich(constellation.coordinates_equatorial(minutes, sats))
+
+
+def _bisect(constellation, points, sats, lo, hi, lo_visible, tol):
+    """
+    :param points: numpy.array of shape (K, 3) - observers, satellite sats[k] is visible from points[k] at lo[k]
+        exactly when lo_visible[k] and at hi[k] exactly when not
+    :return: numpy.array of shape (K,) - the horizon crossings within tol minutes
+    """
+    for _ in range(max(0, int(np.ceil(np.log2(np.max(hi - lo, initial=0)/tol))))):
+        middle = (lo + hi)/2
+        visible = visibility_margin(points, _coordinates_greenwich(constellation, sats, middle)) > 0
+        same = visible == lo_visible
+        lo = np.where(same, middle, lo)
+        hi = np.where(same, hi, middle)
+    return (lo + hi)/2
+
+
+def predict_passes(where, start, duration, constellation=None, samples_per_orbit=60, tol=1e-3, chunk_size=64):
+    """
+    Rise and set times of every satellite for every observer. Visibility is sampled on a grid of samples_per_orbit
+    points per period of the fastest satellite, every change between two samples is then bisected down to tol, so
+    passes and gaps between them shorter than the grid step may be missed.
+    :param where: [[psi, lam], ...] radians - observers spherical coordinates, shape (M, 2)
+    :param start: datetime.datetime with timezone, or anything else minutes_since_spring_equinox accepts for one time
+    :param duration: minutes - length of the predicted span
+    :param constellation: Constellation, all_constellation by default
+    :param samples_per_orbit: int - coarse grid density
+    :param tol: minutes - accuracy of the rise and set times
+    :param chunk_size: int - observers checked together, bounds the memory used
+    :return: Passes of numpy.arrays, observer and satellite are indices into where and constellation
+    """
+    if constellation is None:
+        constellation = registry.get('all')
+
+    where = np.asarray(where, dtype=float).reshape(-1, 2)
+    points_cds = spherical_to_rectangular(np.insert(where, 0, Earth.R, axis=1))
+    start = float(minutes_since_spring_equinox(start))
+    stop = start + duration
+
+    step = np.min(2*np.pi/constellation.w)/samples_per_orbit
+    grid = np.linspace(start, stop, max(2, int(np.ceil(duration/step)) + 1))
+    # (T, S, 3), shared by all observers
+    sats_cds = np.swapaxes(constellation.coordinates_greenwich(grid), 0, 1)
+
+    parts = []
+    for first in range(0, len(points_cds), chunk_size):
+        points = points_cds[first:first + chunk_size]
+        # (m, S, T)
+        visible = np.swapaxes(sats_really_visible(points, sats_cds), 1, 2)
+
+        m, s, t = np.nonzero(visible[..., 1:] != visible[..., :-1])
+        crossings = _bisect(constellation, points[m], s, grid[t], grid[t + 1], visible[m, s, t], tol)
+
+        # passes in progress at the ends of the span get a rise at start or a set at stop
+        m_start, s_start = np.nonzero(visible[..., 0])
+        m_stop, s_stop = np.nonzero(visible[..., -1])
+        observer = np.concatenate([m, m_start, m_stop])
+        satellite = np.concatenate([s, s_start, s_stop])
+        times = np.concatenate([crossings, np.full(len(m_start), start), np.full(len(m_stop), stop)])
+        rising = np.concatenate([~visible[m, s, t], np.ones(len(m_start), bool), np.zeros(len(m_stop), bool)])
+
+        # rises and sets alternate for every observer and satellite, starting with a rise
+        order = np.lexsort((times, satellite, observer))
+        rises, sets = order[rising[order]], order[~rising[order]]
+        parts.append((observer[rises] + first, satellite[rises], times[rises], times[sets]))
+
+    return Passes(*[np.concatenate(columns) for columns in zip(*parts)])
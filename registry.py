@@ -0,0 +1,120 @@
+import json
+import os
+import threading
+
+import numpy as np
+
+from satellites import Constellation
+
+# Constellations are described by JSON definitions, {name: definition}, and built on first use:
+# {"model": "circular", "orbit": {"i": 60, "R": 15000, "w": 2},
+#  "satellites": [{"omega_big": 0, "tau": 30}, {"omega_big": 45, "tau": 100, "omega": 90}, ...]}
+# Angles are in degrees, w in degrees/min, R in km, tau in minutes. Every satellite element not given falls back to
+# the "orbit" one, omega to 0. {"model": "union", "include": [name, ...]} joins other constellations in that order.
+
+DEFAULT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'constellations.json')
+
+_models = {}
+_definitions = {}
+_constellations = {}
+# reentrant: building a union builds the constellations it includes
+_lock = threading.RLock()
+_default_loaded = False
+
+
+def register_model(name, factory):
+    """
+    :param name: str - value of "model" in the definitions it builds
+    :param factory: callable (definition dict) -> Constellation
+    """
+    _models[name] = factory
+
+
+def register(name, definition):
+    """
+    :param name: str - constellation name, replaces an earlier definition with the same name
+    :param definition: dict - see the top of the module
+    """
+    with _lock:
+        _definitions[name] = definition
+        # anything built from the old definition, unions included, is stale now
+        _constellations.clear()
+
+
+def unregister(name):
+    """
+    :param name: str - registered constellation name, a constellations.json one comes back only with load
+    """
+    with _lock:
+        _load_default()
+        del _definitions[name]
+        _constellations.clear()
+
+
+def load(path=DEFAULT_PATH):
+    """
+    :param path: JSON file with {name: definition}, registered in addition to the ones already known
+    """
+    with open(path) as definitions:
+        definitions = json.load(definitions)
+    for name, definition in definitions.items():
+        register(name, definition)
+
+
+def _load_default():
+    # definitions registered before the first use take precedence over the default ones with the same name
+    global _default_loaded
+    if not _default_loaded:
+        _default_loaded = True
+        with open(DEFAULT_PATH) as definitions:
+            for name, definition in json.load(definitions).items():
+                _definitions.setdefault(name, definition)
+
+
+def names():
+    """
+    :return: [str, ...] - names of the registered constellations
+    """
+    with _lock:
+        _load_default()
+        return list(_definitions)
+
+
+def get(name):
+    """
+    :param name: str - registered constellation name, constellations.json ones are registered on first use
+    :return: Constellation, built once and shared by all callers
+    """
+    with _lock:
+        _load_default()
+        if name not in _constellations:
+            if name not in _definitions:
+                raise KeyError('Unknown constellation: {}'.format(name))
+            definition = _definitions[name]
+            _constellations[name] = _models[definition.get('model', 'circular')](definition)
+        return _constellations[name]
+
+
+def satellites(name):
+    """
+    :return: [Satellite, ...] - satellites of the constellation one by one
+    """
+    return list(get(name))
+
+
+def _circular(definition):
+    orbit = definition.get('orbit', {})
+    elements = {name: [satellite.get(name, orbit.get(name, 0)) for satellite in definition['satellites']]
+                for name in Constellation.ELEMENTS}
+    for name in ('omega_big', 'i', 'w', 'omega'):
+        elements[name] = np.radians(elements[name])
+    return Constellation(*[elements[name] for name in Constellation.ELEMENTS])
+
+
+def _union(definition):
+    parts = [get(name) for name in definition['include']]
+    return Constellation(*[np.concatenate([getattr(part, name) for part in parts]) for name in Constellation.ELEMENTS])
+
+
+register_model('circular', _circular)
+register_model('union', _union)
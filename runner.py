@@ -0,0 +1,127 @@
+import os
+import time
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from satellites import Constellation
+from tasks import get_visible_satellites_batch, rho_rho3_batch, doppler_stream
+import registry
+
+
+# timing of one shard: its position in the input, number of rows, seconds spent in the worker and worker pid
+ShardReport = namedtuple('ShardReport', ['index', 'size', 'seconds', 'pid'])
+
+# constellation a worker process attached to, set once by _attach_constellation
+_constellation = None
+
+
+class SharedConstellation:
+    """
+    Orbital elements of a Constellation copied into one shared memory block, so that worker processes map them
+    instead of receiving a pickled copy with every task. Use as a context manager, the block is freed on exit.
+    """
+
+    def __init__(self, constellation):
+        elements = np.stack([getattr(constellation, name) for name in Constellation.ELEMENTS])
+        self.memory = shared_memory.SharedMemory(create=True, size=elements.nbytes)
+        np.ndarray(elements.shape, dtype=elements.dtype, buffer=self.memory.buf)[:] = elements
+        # picklable description of the block, all a worker needs to attach to it
+        self.descriptor = (self.memory.name, elements.shape)
+
+    def close(self):
+        self.memory.close()
+        self.memory.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def _attach_constellation(descriptor):
+    global _constellation
+    name, shape = descriptor
+    # pool workers share the resource tracker of the parent, which unlinks the block once in SharedConstellation.close
+    memory = shared_memory.SharedMemory(name=name)
+    elements = np.ndarray(shape, dtype=float, buffer=memory.buf)
+    _constellation = Constellation(*elements)
+    _constellation.memory = memory
+
+
+def _run_shard(job, index, shard, common):
+    start = time.perf_counter()
+    result = job(_constellation, *shard, **common)
+    return result, ShardReport(index, len(shard[0]), time.perf_counter() - start, os.getpid())
+
+
+def _concatenate(results):
+    if isinstance(results[0], tuple):
+        return tuple(_concatenate(list(parts)) for parts in zip(*results))
+    return np.concatenate(results)
+
+
+def run_sharded(job, *sharded, constellation=None, shards=None, processes=None, **common):
+    """
+    Splits the inputs along their first axis and runs job on every shard in a pool of processes
+    :param job: module level function job(constellation, *shard_arrays, **common) returning a numpy.array or a
+        tuple of them with a row per input row
+    :param sharded: numpy.arrays with the same number of rows, split between the shards
+    :param constellation: Constellation the job works with, all_constellation by default
+    :param shards: int - number of shards, 4 per process by default
+    :param processes: int - number of worker processes, os.cpu_count() by default
+    :param common: keyword arguments passed to every shard as they are
+    :return: (results merged in input order, [ShardReport, ...] in input order)
+    """
+    if constellation is None:
+        constellation = registry.get('all')
+    if len(sharded[0]) == 0:
+        # nothing to split, the job itself gives its empty results the right shapes and types
+        return job(constellation, *[np.asarray(array) for array in sharded], **common), []
+    processes = processes or os.cpu_count()
+    shards = shards or 4*processes
+
+    rows = np.array_split(np.arange(len(sharded[0])), min(shards, len(sharded[0])))
+    with SharedConstellation(constellation) as shared, \
+            ProcessPoolExecutor(processes, initializer=_attach_constellation, initargs=(shared.descriptor,)) as pool:
+        futures = [pool.submit(_run_shard, job, index, [np.asarray(array)[shard] for array in sharded], common)
+                   for index, shard in enumerate(rows)]
+        results, reports = zip(*[future.result() for future in futures])
+
+    return _concatenate(list(results)), list(reports)
+
+
+def visibility_job(constellation, where, when):
+    """
+    :param where: numpy.array of shape (M, 2) - observers shard, see get_visible_satellites_batch
+    :param when: epochs, the same for all shards
+    :return: bool numpy.array of shape (M, T, S)
+    """
+    return get_visible_satellites_batch(where, when, constellation)
+
+
+def rho_rho3_job(constellation, position, sats_cds, distances, **options):
+    """
+    :param position: numpy.array of shape (N, 3) - fixes shard, see rho_rho3_batch
+    :param sats_cds: numpy.array of shape (N, K, 3)
+    :param distances: numpy.array of shape (N, K)
+    :return: (positions of shape (N, 3), iterations of shape (N,))
+    """
+    return rho_rho3_batch(position, sats_cds, distances, **options)
+
+
+def doppler_job(constellation, when, doppler_values, position, **options):
+    """
+    :param when: numpy.array of shape (N,) - epochs of a measurements shard, see doppler_stream
+    :param doppler_values: numpy.array of shape (N, S) - rho_dot for every satellite, nan if not tracked
+    :param position: [R, psi, lam] km radians - approximate position for the first fix of the shard
+    :return: (positions of shape (N, 3), iterations of shape (N,), converged of shape (N,))
+    """
+    results = [result for _, result in doppler_stream(zip(when, doppler_values), position, constellation,
+                                                      **options)]
+    return (np.array([result.position for result in results]),
+            np.array([result.iterations for result in results]),
+            np.array([result.converged for result in results]))
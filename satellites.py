@@ -1,25 +1,29 @@
 import numpy as np
-from math import sin, cos, radians
+from math import sin, cos, radians, degrees
 
-from utils import *
-from translations import *
-from earth import *
+from translations import earth_rotation
 
 
 class Satellite:
-    # eps, omega = 0, 0
-
-    def __init__(self, omega_big, tau):
+    # eps = 0
+    # no per-instance __dict__: a satellite is just its elements and the orbit plane rotation
+    __slots__ = ('omega_big', 'tau', 'i', 'R', 'w', 'omega', 'orbit_rotation')
+
+    def __init__(self, omega_big, tau, i=0, R=0, w=0, omega=0):
+        """
+        :param omega_big: degrees - longitude of the ascending node
+        :param tau: minutes - time the argument of latitude equals omega
+        :param i: radians - orbit inclination
+        :param R: km - orbit radius
+        :param w: radians/min - angular speed
+        :param omega: radians - argument of latitude at tau, 0 when tau is the time of passing the ascending node
+        """
         self.omega_big = radians(omega_big)
         self.tau = tau
-        self.i, self.R, self.w = 0, 0, 0
-
-    def coordinates_equatorial(self, minutes):
-        # u = self.omega + self.w*(t-self.tau)  # omega = 0
-        u = self.w*(minutes - self.tau)
-
-        in_orbit_plane = self.R*np.array([cos(u), sin(u), 0])
+        self.i, self.R, self.w, self.omega = i, R, w, omega
 
+        # orbit plane doesn't move, so around_z.dot(around_x) is computed once. only its first two columns
+        # are ever needed: in_orbit_plane has zero z component
         around_x = np.array([[1,           0,            0],
                              [0, cos(self.i), -sin(self.i)],
                              [0, sin(self.i),  cos(self.i)]])
@@ -28,37 +32,180 @@ class Satellite:
                              [sin(self.omega_big),  cos(self.omega_big), 0],
                              [                  0,                    0, 1]])
 
-        return around_z.dot(around_x).dot(in_orbit_plane)
+        self.orbit_rotation = around_z.dot(around_x)
+
+    def _argument_of_latitude(self, minutes):
+        u = self.omega + self.w*(np.asarray(minutes, dtype=float) - self.tau)
+        return np.cos(u)[..., np.newaxis], np.sin(u)[..., np.newaxis]
+
+    def coordinates_equatorial(self, minutes):
+        """
+        :param minutes: scalar or numpy.array of shape (N,) - minutes since spring equinox
+        :return: [x, y, z] numpy.array, or numpy.array of shape (N, 3) for an array of times
+        """
+        cos_u, sin_u = self._argument_of_latitude(minutes)
+        return self.R*(cos_u*self.orbit_rotation[:, 0] + sin_u*self.orbit_rotation[:, 1])
 
     def coordinates_greenwich(self, minutes):
-        gamma = Earth.w_sun*minutes + Earth.w_self*minutes
-        # return greenwich_to_equatorial(self.coordinates_equatorial(minutes), gamma)
-        return equatorial_to_greenwich(self.coordinates_equatorial(minutes), gamma)
+        # return earth_rotation(minutes).to_equatorial(self.coordinates_equatorial(minutes))
+        return earth_rotation(minutes).to_greenwich(self.coordinates_equatorial(minutes))
 
     def speed_equatorial(self, minutes):
-        u = self.w*(minutes - self.tau)
-
-        return self.R * self.w * \
-               np.array([-sin(u)*cos(self.omega_big) - cos(u)*sin(self.omega_big)*cos(self.i),
-                         -sin(u)*sin(self.omega_big) + cos(u)*cos(self.omega_big)*cos(self.i),
-                         cos(u)*sin(self.i)])
+        """
+        :param minutes: scalar or numpy.array of shape (N,) - minutes since spring equinox
+        :return: [xdot, ydot, zdot] numpy.array, or numpy.array of shape (N, 3) for an array of times
+        """
+        cos_u, sin_u = self._argument_of_latitude(minutes)
+        return self.R*self.w*(cos_u*self.orbit_rotation[:, 1] - sin_u*self.orbit_rotation[:, 0])
 
     def speed_greenwich(self, minutes):
-        gamma = Earth.w_sun*minutes + Earth.w_self*minutes
-        return greenwich_to_equatorial(self.speed_equatorial(minutes), gamma)
+        return earth_rotation(minutes).to_equatorial(self.speed_equatorial(minutes))
 
 
 class TransitSatellite(Satellite):
-    def __init__(self, omega_big, tau):
-        super().__init__(omega_big, tau)
-        self.i = radians(90)  # degrees -> radians
-        self.R = 7500  # km
-        self.w = radians(3)  # degrees/min -> radians/min
+    __slots__ = ()
+
+    def __init__(self, omega_big, tau, omega=0):
+        super().__init__(omega_big, tau,
+                         i=radians(90),  # degrees -> radians
+                         R=7500,  # km
+                         w=radians(3),  # degrees/min -> radians/min
+                         omega=omega)
 
 
 class GPSSatellite(Satellite):
-    def __init__(self, omega_big, tau):
-        super().__init__(omega_big, tau)
-        self.i = radians(60)  # degrees -> radians
-        self.R = 15000  # km
-        self.w = radians(2)  # degrees/min -> radians/min
+    __slots__ = ()
+
+    def __init__(self, omega_big, tau, omega=0):
+        super().__init__(omega_big, tau,
+                         i=radians(60),  # degrees -> radians
+                         R=15000,  # km
+                         w=radians(2),  # degrees/min -> radians/min
+                         omega=omega)
+
+
+class Constellation:
+    """
+    Satellites with their orbital elements kept in contiguous arrays, one entry per satellite, so that the whole
+    constellation is propagated for all requested times in one numpy broadcast
+    """
+
+    # orbital elements, in the order __init__ takes them
+    ELEMENTS = ('omega_big', 'tau', 'i', 'R', 'w', 'omega')
+
+    def __init__(self, omega_big, tau, i, R, w, omega=0):
+        """
+        :param omega_big: numpy.array of shape (S,) radians - longitudes of the ascending nodes
+        :param tau: numpy.array of shape (S,) minutes - times of passing the ascending nodes
+        :param i: numpy.array of shape (S,) radians - orbit inclinations
+        :param R: numpy.array of shape (S,) km - orbit radii
+        :param w: numpy.array of shape (S,) radians/min - angular speeds
+        :param omega: numpy.array of shape (S,) radians - arguments of latitude at tau
+        """
+        self.omega_big, self.tau, self.i, self.R, self.w, self.omega = \
+            np.broadcast_arrays(*[np.atleast_1d(np.asarray(x, dtype=float))
+                                  for x in (omega_big, tau, i, R, w, omega)])
+
+        # first two columns of around_z.dot(around_x) for every satellite, see Satellite.__init__
+        cos_o, sin_o = np.cos(self.omega_big), np.sin(self.omega_big)
+        cos_i, sin_i = np.cos(self.i), np.sin(self.i)
+        self.node = np.stack([cos_o, sin_o, np.zeros_like(cos_o)], axis=-1)
+        self.normal_to_node = np.stack([-sin_o*cos_i, cos_o*cos_i, sin_i], axis=-1)
+
+    @classmethod
+    def from_satellites(cls, satellites):
+        """
+        :param satellites: iterable of Satellite objects
+        :return: Constellation with the same satellites in the same order
+        """
+        satellites = list(satellites)
+        return cls(*[[getattr(sat, name) for sat in satellites] for name in cls.ELEMENTS])
+
+    def save(self, path):
+        """
+        :param path: directory to write the 'satellites' dataset to, see storage.py
+        """
+        from storage import save_columns
+        save_columns(path, 'satellites', **{name: getattr(self, name) for name in self.ELEMENTS})
+
+    @classmethod
+    def load(cls, path):
+        """
+        :param path: directory written by save
+        :return: Constellation
+        """
+        from storage import load_columns
+        columns, _ = load_columns(path, mmap_mode=None)
+        # datasets saved before omega was added don't have it
+        return cls(*[columns.get(name, 0) for name in cls.ELEMENTS])
+
+    def __len__(self):
+        return len(self.omega_big)
+
+    def __getitem__(self, index):
+        """
+        :param index: int - satellite index in the constellation
+        :return: Satellite with the orbital elements of that satellite
+        """
+        return Satellite(degrees(self.omega_big[index]), self.tau[index],
+                         self.i[index], self.R[index], self.w[index], self.omega[index])
+
+    def __iter__(self):
+        return (self[index] for index in range(len(self)))
+
+    def _orbits(self, minutes, sats=None):
+        """
+        :param minutes: scalar or numpy.array of shape (T,), or of shape (K,) with sats
+        :param sats: int numpy.array of shape (K,) - satellite sats[k] is taken at minutes[k], every satellite at every
+            time if None
+        :return: (cos(u), sin(u), R*node, R*normal_to_node, w), broadcast to (S, [T,] 3) or (K, 3)
+        """
+        minutes = np.asarray(minutes, dtype=float)
+        if sats is None:
+            shape = (len(self),) + (1,)*minutes.ndim
+            elements = [element.reshape(shape) for element in (self.omega, self.w, self.tau)]
+            vectors = [(self.R[:, np.newaxis]*vector).reshape(shape + (3,))
+                       for vector in (self.node, self.normal_to_node)]
+        else:
+            elements = [element[sats] for element in (self.omega, self.w, self.tau)]
+            vectors = [self.R[sats, np.newaxis]*vector[sats] for vector in (self.node, self.normal_to_node)]
+        omega, w, tau = elements
+        u = omega + w*(minutes - tau)
+        return (np.cos(u)[..., np.newaxis], np.sin(u)[..., np.newaxis]) + tuple(vectors) + (w[..., np.newaxis],)
+
+    def coordinates_equatorial(self, minutes, sats=None):
+        """
+        :param minutes: scalar or numpy.array of shape (T,) - minutes since spring equinox
+        :param sats: int numpy.array of shape (K,) - only satellite sats[k] at minutes[k], for times that differ between
+            the satellites, minutes of shape (K,) then
+        :return: numpy.array of shape (S, 3), or (S, T, 3) for an array of times, (K, 3) with sats
+        """
+        cos_u, sin_u, node, normal_to_node, _ = self._orbits(minutes, sats)
+        return cos_u*node + sin_u*normal_to_node
+
+    def coordinates_greenwich(self, minutes, sats=None):
+        return earth_rotation(minutes).to_greenwich(self.coordinates_equatorial(minutes, sats))
+
+    def speed_equatorial(self, minutes, sats=None):
+        """
+        :param minutes: scalar or numpy.array of shape (T,) - minutes since spring equinox
+        :param sats: see coordinates_equatorial
+        :return: numpy.array of shape (S, 3), or (S, T, 3) for an array of times, (K, 3) with sats
+        """
+        cos_u, sin_u, node, normal_to_node, w = self._orbits(minutes, sats)
+        return w*(cos_u*normal_to_node - sin_u*node)
+
+    def speed_greenwich(self, minutes, sats=None):
+        return earth_rotation(minutes).to_equatorial(self.speed_equatorial(minutes, sats))
+
+    def states_greenwich(self, minutes, sats=None):
+        """
+        :param minutes: scalar or numpy.array of shape (T,) - minutes since spring equinox
+        :param sats: see coordinates_equatorial
+        :return: (coordinates_greenwich(minutes), speed_greenwich(minutes)), sharing the argument of latitude and the
+            Earth rotation
+        """
+        cos_u, sin_u, node, normal_to_node, w = self._orbits(minutes, sats)
+        rotation = earth_rotation(minutes)
+        return (rotation.to_greenwich(cos_u*node + sin_u*normal_to_node),
+                rotation.to_equatorial(w*(cos_u*normal_to_node - sin_u*node)))
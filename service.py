@@ -0,0 +1,252 @@
+"""
+Local asyncio service answering visibility and positioning queries, one JSON object per line in both directions.
+
+    python service.py --port 8765
+    python service.py --unix /tmp/satellites.sock
+
+    {"id": 1, "method": "visible", "params": {"where": [psi, lam], "when": "2015-06-11T20:00:00+00:00"}}
+    {"id": 1, "result": [2, 7, 8]}
+
+Requests a connection sends are answered as they complete, so responses may come out of order, matched by id.
+Requests arriving within a few milliseconds of each other are coalesced: ones for the same method, epoch and
+satellites set are solved as one batch in the worker pool, keeping the event loop free for reading more.
+
+Methods and their params, angles in radians, "when" is an ISO 8601 string (UTC if without timezone) or a POSIX
+timestamp, "constellation" is a registry name, "all" by default:
+    visible: where [psi, lam], when, constellation -> indices of the visible satellites in the constellation
+    rho_rho3: position [R, psi, lam], sats_cds [[x, y, z], ...], distances [x, ...], weights (optional)
+        -> {"position": [R, psi, lam] km degrees, "iterations": n, "converged": bool}, see tasks.rho_rho3
+    doppler: position [R, psi, lam], when, rho_dot [rhodot or null for satellites not tracked, ...] for every
+        satellite of the constellation, speed [xdot, ydot, zdot] (optional), constellation
+        -> {"position": [R, psi, lam] km radians, "iterations": n, "converged": bool}, see tasks.doppler
+
+A request whose own system is singular gets an error, the others coalesced with it are answered as usual.
+"""
+import argparse
+import asyncio
+import json
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import numpy as np
+
+from tasks import get_visible_satellites_batch, rho_rho3_batch, doppler_batch
+from utils import minutes_since_spring_equinox, _to_datetime64
+import registry
+
+
+def _epoch(when):
+    """
+    :return: numpy.datetime64 in UTC, hashable, so that requests for the same moment share a key
+    """
+    if isinstance(when, str):
+        when = datetime.fromisoformat(when)
+    return _to_datetime64(when if isinstance(when, datetime) else float(when))
+
+
+def _parse_visible(params):
+    where = np.asarray(params['where'], dtype=float)
+    if where.shape != (2,):
+        raise ValueError('where must be [psi, lam]')
+    return (params.get('constellation', 'all'), _epoch(params['when'])), where
+
+
+def _solve_visible(key, requests):
+    name, when = key
+    visible = get_visible_satellites_batch(np.array(requests), np.array([when]), registry.get(name))[:, 0]
+    return [np.flatnonzero(row).tolist() for row in visible]
+
+
+def _parse_rho_rho3(params):
+    position = np.asarray(params['position'], dtype=float)
+    sats_cds = np.asarray(params['sats_cds'], dtype=float)
+    distances = np.asarray(params['distances'], dtype=float)
+    weights = params.get('weights')
+    if position.shape != (3,) or sats_cds.ndim != 2 or sats_cds.shape[1:] != (3,) or len(sats_cds) < 3 or \
+            distances.shape != sats_cds.shape[:1]:
+        raise ValueError('position must be [R, psi, lam], sats_cds 3 or more [x, y, z] and a distance for each')
+    if weights is not None:
+        weights = np.asarray(weights, dtype=float)
+        if weights.shape != distances.shape:
+            raise ValueError('weights must have a weight for each distance')
+    return (len(sats_cds), weights is not None), (position, sats_cds, distances, weights)
+
+
+def _fixes(result):
+    # one response per fix of a batch solver full_output, an exception for the singular ones
+    return [{'position': position.tolist(), 'iterations': int(iterations), 'converged': bool(converged)}
+            if iterations >= 0 else np.linalg.LinAlgError('Singular matrix')
+            for position, iterations, converged in zip(result.position, result.iterations, result.converged)]
+
+
+def _solve_rho_rho3(key, requests):
+    position, sats_cds, distances, weights = zip(*requests)
+    return _fixes(rho_rho3_batch(np.array(position), np.array(sats_cds), np.array(distances),
+                                 weights=np.array(weights) if key[1] else None, full_output=True))
+
+
+def _parse_doppler(params):
+    name = params.get('constellation', 'all')
+    position = np.asarray(params['position'], dtype=float)
+    speed = np.asarray(params.get('speed', (0, 0, 0)), dtype=float)
+    rho_dot = np.array([np.nan if value is None else value for value in params['rho_dot']], dtype=float)
+    tracked = ~np.isnan(rho_dot)
+    if position.shape != (3,) or speed.shape != (3,) or len(rho_dot) != len(registry.get(name)):
+        raise ValueError('position and speed must be 3 values, rho_dot a value for every satellite')
+    if np.count_nonzero(tracked) < 3:
+        raise ValueError('at least 3 satellites must be tracked')
+    return (name, _epoch(params['when']), tracked.tobytes()), (position, speed, rho_dot[tracked])
+
+
+def _solve_doppler(key, requests):
+    name, when, tracked = key
+    tracked = np.frombuffer(tracked, dtype=bool)
+    # the satellites states are computed once for all fixes of the epoch
+    sats_positions, sats_speeds = registry.get(name).states_greenwich(minutes_since_spring_equinox(when))
+    position, speed, rho_dot = [np.array(column) for column in zip(*requests)]
+    shape = (len(requests),) + sats_positions[tracked].shape
+    return _fixes(doppler_batch(position, speed, np.broadcast_to(sats_positions[tracked], shape),
+                                np.broadcast_to(sats_speeds[tracked], shape), rho_dot, full_output=True))
+
+
+# method: (parse params into (batch key, request), solve(key, [request, ...]) -> [result or exception, ...])
+METHODS = {'visible': (_parse_visible, _solve_visible),
+           'rho_rho3': (_parse_rho_rho3, _solve_rho_rho3),
+           'doppler': (_parse_doppler, _solve_doppler)}
+
+
+class Service:
+    """
+    Coalesces concurrent calls into batches and runs them in an executor, see the module docstring
+    """
+
+    def __init__(self, executor=None, window=0.002, max_batch=4096):
+        """
+        :param executor: concurrent.futures.Executor the batches run in, a thread pool by default. A process pool
+            only knows the constellations registered in constellations.json
+        :param window: seconds - how long the first request of a batch waits for others to join it
+        :param max_batch: int - a batch this large is run without waiting for the window to pass
+        """
+        self.executor = executor or ThreadPoolExecutor()
+        self.window = window
+        self.max_batch = max_batch
+        # (method, key) -> [(request, future), ...] waiting to be run
+        self._pending = {}
+        self._running = set()
+
+    async def call(self, method, params):
+        """
+        :param method: str - one of METHODS
+        :param params: dict - see the module docstring
+        :return: JSON serializable result, solved in a batch with the other calls with the same method and key
+        """
+        if method not in METHODS:
+            raise ValueError('Unknown method: {}'.format(method))
+        key, request = METHODS[method][0](params)
+
+        loop = asyncio.get_running_loop()
+        batch = self._pending.get((method, key))
+        if batch is None:
+            batch = self._pending[method, key] = []
+            loop.call_later(self.window, self._flush, method, key, batch)
+        future = loop.create_future()
+        batch.append((request, future))
+        if len(batch) >= self.max_batch:
+            self._flush(method, key, batch)
+        return await future
+
+    def _flush(self, method, key, batch):
+        # the timer of a batch flushed early for being full finds another batch or none under the key
+        if self._pending.get((method, key)) is batch:
+            del self._pending[method, key]
+            task = asyncio.ensure_future(self._run(method, key, batch))
+            self._running.add(task)
+            task.add_done_callback(self._running.discard)
+
+    async def _run(self, method, key, batch):
+        requests, futures = zip(*batch)
+        solve = METHODS[method][1]
+        loop = asyncio.get_running_loop()
+        try:
+            results = await loop.run_in_executor(self.executor, solve, key, list(requests))
+        except Exception as error:
+            if len(requests) == 1:
+                results = [error]
+            else:
+                # a request breaking the whole batch must not fail the others: each one is solved on its own
+                results = await asyncio.gather(*[loop.run_in_executor(self.executor, solve, key, [request])
+                                                 for request in requests], return_exceptions=True)
+                results = [result if isinstance(result, Exception) else result[0] for result in results]
+        for future, result in zip(futures, results):
+            if future.done():
+                continue
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+    async def _respond(self, line, writer):
+        request_id = None
+        try:
+            message = json.loads(line)
+            request_id = message.get('id')
+            response = {'id': request_id, 'result': await self.call(message['method'], message.get('params', {}))}
+        except Exception as error:
+            response = {'id': request_id, 'error': '{}: {}'.format(type(error).__name__, error)}
+        try:
+            writer.write((json.dumps(response) + '\n').encode())
+            await writer.drain()
+        except ConnectionError:
+            # the client is gone, nobody to answer to
+            pass
+
+    async def handle(self, reader, writer):
+        """
+        asyncio.start_server callback serving one connection until the client closes it
+        """
+        responses = set()
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                if line.strip():
+                    task = asyncio.ensure_future(self._respond(line, writer))
+                    responses.add(task)
+                    task.add_done_callback(responses.discard)
+            if responses:
+                await asyncio.gather(*responses)
+        finally:
+            writer.close()
+
+    async def start(self, host='127.0.0.1', port=8765, path=None):
+        """
+        :param path: Unix socket path, host and port are used if None
+        :return: asyncio.Server, already accepting connections
+        """
+        if path is not None:
+            return await asyncio.start_unix_server(self.handle, path)
+        return await asyncio.start_server(self.handle, host, port)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--unix', help='Unix socket path to listen on instead of host and port')
+    parser.add_argument('--workers', type=int, help='worker threads, one per CPU by default')
+    parser.add_argument('--window', type=float, default=0.002, help='seconds a batch waits for more requests')
+    args = parser.parse_args(argv)
+
+    async def serve():
+        service = Service(ThreadPoolExecutor(args.workers), window=args.window)
+        server = await service.start(args.host, args.port, args.unix)
+        async with server:
+            await server.serve_forever()
+
+    asyncio.run(serve())
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,68 @@
+import json
+import os
+import numpy as np
+
+# A dataset is a directory with a .npy file per column and meta.json describing it:
+# {"kind": "measurements", "rows": N, "columns": ["when", "rho_dot"], ...any extra metadata}
+# Columns are plain .npy files, so they are memory-mapped for zero-copy reads and sliced into row chunks.
+
+
+def save_columns(path, kind, meta=None, **columns):
+    """
+    :param path: dataset directory, created if missing
+    :param kind: str - what the dataset holds, e.g. 'ephemeris', 'satellites', 'measurements', 'fixes'
+    :param meta: dict - extra JSON serializable metadata
+    :param columns: numpy.arrays to store, row-aligned ones share the first dimension
+    """
+    os.makedirs(path, exist_ok=True)
+    for name, column in columns.items():
+        np.save(os.path.join(path, name + '.npy'), column)
+    _write_meta(path, kind, len(next(iter(columns.values()))), list(columns), meta)
+
+
+def create_columns(path, kind, rows, meta=None, **specs):
+    """
+    Allocates a dataset on disk to be filled chunk by chunk
+    :param path: dataset directory, created if missing
+    :param kind: str - what the dataset holds
+    :param rows: int - number of rows
+    :param meta: dict - extra JSON serializable metadata
+    :param specs: (dtype, row_shape) for every column
+    :return: {name: writable numpy.memmap of shape (rows,) + row_shape}
+    """
+    os.makedirs(path, exist_ok=True)
+    columns = {name: np.lib.format.open_memmap(os.path.join(path, name + '.npy'), mode='w+', dtype=dtype,
+                                               shape=(rows,) + tuple(row_shape))
+               for name, (dtype, row_shape) in specs.items()}
+    _write_meta(path, kind, rows, list(specs), meta)
+    return columns
+
+
+def load_columns(path, mmap_mode='r'):
+    """
+    :param path: dataset directory written by save_columns or create_columns
+    :param mmap_mode: passed to numpy.load, 'r' maps the columns instead of reading them, None reads them
+    :return: ({name: numpy.array}, meta dict)
+    """
+    with open(os.path.join(path, 'meta.json')) as meta:
+        meta = json.load(meta)
+    columns = {name: np.load(os.path.join(path, name + '.npy'), mmap_mode=mmap_mode) for name in meta['columns']}
+    return columns, meta
+
+
+def iter_chunks(columns, chunk_size):
+    """
+    :param columns: {name: numpy.array} with the same number of rows, e.g. from load_columns
+    :param chunk_size: int - rows per chunk
+    :return: generator of (start row, {name: rows [start, start + chunk_size) of the column}), views, not copies
+    """
+    rows = len(next(iter(columns.values())))
+    for start in range(0, rows, chunk_size):
+        yield start, {name: column[start:start + chunk_size] for name, column in columns.items()}
+
+
+def _write_meta(path, kind, rows, names, meta):
+    description = dict(meta or {})
+    description.update(kind=kind, rows=rows, columns=names)
+    with open(os.path.join(path, 'meta.json'), 'w') as output:
+        json.dump(description, output)
@@ -1,158 +1,696 @@
 import numpy as np
-from math import sin, cos, radians, degrees
-from datetime import datetime, timezone, timedelta
+from collections import namedtuple
+from itertools import islice
+from math import degrees
+from datetime import timezone, timedelta
 
-from translations import *
-from satellites import *
-from utils import *
-from tests import *
+from earth import Earth
+from translations import spherical_to_rectangular, rectangular_to_spherical
+from utils import GroundStation, minutes_since_spring_equinox, sat_really_visible, sats_really_visible, \
+    range_residuals, range_residuals_spherical, rho_dot_residuals, least_squares_step, least_squares_steps
+from satellites import TransitSatellite, GPSSatellite
+from storage import create_columns, load_columns, iter_chunks
+import instrumentation
+import registry
 
-transit_sats = [TransitSatellite(30, 40), TransitSatellite(60, 10), TransitSatellite(120, 100),
-                TransitSatellite(210, 80), TransitSatellite(270, 50), TransitSatellite(330, 110)]
+__all__ = ['SolverResult', 'get_visible_satellites', 'get_visible_satellites_batch', 'rho_rho2', 'rho_rho3',
+           'rho_rho2_batch', 'rho_rho3_batch', 'get_transition_matrix', 'doppler', 'doppler_batch', 'doppler_pass',
+           'doppler_stream', 'get_visible_satellites_file', 'rho_rho3_file', 'doppler_file',
+           'transit_sats', 'gps_sats', 'transit_constellation', 'gps_constellation', 'all_constellation']
 
-gps_sats = [GPSSatellite(0, 30), GPSSatellite(45, 100), GPSSatellite(90, 70),
-            GPSSatellite(135, 0), GPSSatellite(210, 150), GPSSatellite(300, 120)]
+# transit_sats, gps_sats, transit_constellation, gps_constellation and all_constellation (Transits, then GPSes) are
+# looked up lazily in the registry, see __getattr__ and constellations.json
+_SATELLITES = {'transit_sats': ('transit', TransitSatellite), 'gps_sats': ('gps', GPSSatellite)}
+_CONSTELLATIONS = {'transit_constellation': 'transit', 'gps_constellation': 'gps', 'all_constellation': 'all'}
+# name: (constellation the list was built from, [satellite, ...])
+_satellites = {}
 
 
-def get_visible_satellites(where, when, display=False):
+def __getattr__(name):
+    if name in _CONSTELLATIONS:
+        # the registry keeps the built constellation until one of the definitions changes
+        return registry.get(_CONSTELLATIONS[name])
+    if name in _SATELLITES:
+        constellation_name, cls = _SATELLITES[name]
+        constellation = registry.get(constellation_name)
+        # a new constellation object means registry.register replaced the definitions, the list is rebuilt then
+        if name not in _satellites or _satellites[name][0] is not constellation:
+            _satellites[name] = constellation, [_satellite(constellation, k, cls) for k in range(len(constellation))]
+        return _satellites[name][1]
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+
+
+def _satellite(constellation, k, cls):
+    # the subclass only when the registered orbit is its own, any other orbit keeps all of its elements
+    default = cls(0, 0)
+    if np.allclose([constellation.i[k], constellation.R[k], constellation.w[k]], [default.i, default.R, default.w]):
+        return cls(degrees(constellation.omega_big[k]), constellation.tau[k], constellation.omega[k])
+    return constellation[k]
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_SATELLITES) | set(_CONSTELLATIONS))
+
+
+# position is in the same format the solver returns without full_output, residual is the norm of the measured
+# minus computed values at that position, converged tells whether the last step was shorter than tol
+SolverResult = namedtuple('SolverResult', ['position', 'iterations', 'residual', 'converged'])
+
+
+def get_visible_satellites(where, when, display=False, instrument=None):
     """
-    :param where: [psi, lam] radians - position spherical coordinates
+    :param where: [psi, lam] radians - position spherical coordinates, or a GroundStation
     :param when: datetime.datetime with timezone - date and time
     :param display: bool - defines whether to display information or not
+    :param instrument: instrumentation.Instrument - receives the events and the visibility checks count, the
+        attached one if None, see instrumentation.active
     :return: [[a, b], [c, d]] - Transit and GPS satellites indices
     """
-    # TODO: what are thees? latitude and longitude?
-    psi, lam = where
+    instrument = instrumentation.active(instrument, display)
+    if instrument is not None:
+        started = instrument.call_started('get_visible_satellites')
 
     utc = timezone(timedelta(hours=0))
     when_utc = when.astimezone(utc)
     minutes = minutes_since_spring_equinox(when_utc)
-    if display:
-        print("Date and time:", when_utc.isoformat(' '))
-        print("Minutes since spring equinox:", minutes)
-
-    # next two are identical as angles, mod 2*pi
-    gamma = Earth.w_sun * minutes + Earth.w_self * minutes
-    gamma_test = Earth.w_sun * minutes + Earth.w_self * (when_utc.hour * 60 + when_utc.minute)
-    if display:
-        print("Gamma:", degrees(gamma_test))
 
-    point_cds = spherical_to_rectangular(np.array([Earth.R, psi, lam]))
-    transit_cds = [sat.coordinates_greenwich(minutes) for sat in transit_sats]
-    gps_cds = [sat.coordinates_greenwich(minutes) for sat in gps_sats]
+    if isinstance(where, GroundStation):
+        point_cds = where
+    else:
+        # TODO: what are thees? latitude and longitude?
+        psi, lam = where
+        point_cds = spherical_to_rectangular(np.array([Earth.R, psi, lam]))
+    transit_cds = registry.get('transit').coordinates_greenwich(minutes)
+    gps_cds = registry.get('gps').coordinates_greenwich(minutes)
 
     transit_vis = [i + 1 for i, sat_cds in enumerate(transit_cds) if sat_really_visible(point_cds, sat_cds)]
     gps_vis = [i + 1 for i, sat_cds in enumerate(gps_cds) if sat_really_visible(point_cds, sat_cds)]
-    if display:
-        print('Visible Transits:', list(transit_vis), sep='\n', end='\n\n')
-        print('Visible GPSes:', list(gps_vis), sep='\n', end='\n\n')
+
+    if instrument is not None:
+        # next two are identical as angles, mod 2*pi
+        gamma = Earth.w_sun * minutes + Earth.w_self * minutes
+        gamma_test = Earth.w_sun * minutes + Earth.w_self * (when_utc.hour * 60 + when_utc.minute)
+        instrument.event('get_visible_satellites', 'Date and time', when_utc.isoformat(' '))
+        instrument.event('get_visible_satellites', 'Minutes since spring equinox', minutes)
+        instrument.event('get_visible_satellites', 'Gamma', degrees(gamma_test))
+        instrument.event('get_visible_satellites', 'Visible Transits', transit_vis)
+        instrument.event('get_visible_satellites', 'Visible GPSes', gps_vis)
+        instrument.count('visibility_checks', len(transit_cds) + len(gps_cds))
+        instrument.call_finished('get_visible_satellites', started)
 
     return [transit_vis, gps_vis]
 
 
-def rho_rho2(pos_sph2, sats_cds, distances, display=False):
+def get_visible_satellites_batch(where, when, constellation=None, instrument=None):
+    """
+    :param where: [[psi, lam], ...] radians - observers spherical coordinates, shape (M, 2), or a GroundStation
+    :param when: [datetime.datetime with timezone, ...], numpy.datetime64 array in UTC or POSIX timestamps - epochs,
+        T of them
+    :param constellation: Constellation to check, all_constellation (Transits, then GPSes) by default
+    :param instrument: instrumentation.Instrument - receives the visibility checks count, see get_visible_satellites
+    :return: bool numpy.array of shape (M, T, S) - True where satellite is visible from observer at epoch
+    """
+    instrument = instrumentation.active(instrument)
+    if instrument is not None:
+        started = instrument.call_started('get_visible_satellites_batch')
+
+    if constellation is None:
+        constellation = registry.get('all')
+
+    minutes = np.atleast_1d(minutes_since_spring_equinox(when))
+
+    if isinstance(where, GroundStation):
+        points_cds = where
+    else:
+        where = np.asarray(where, dtype=float).reshape(-1, 2)
+        points_cds = spherical_to_rectangular(np.insert(where, 0, Earth.R, axis=1))
+    # (S, T, 3) -> (T, S, 3): satellites positions are computed once per epoch and shared by all observers
+    sats_cds = np.swapaxes(constellation.coordinates_greenwich(minutes), 0, 1)
+    visible = sats_really_visible(points_cds, sats_cds)
+
+    if instrument is not None:
+        instrument.count('visibility_checks', visible.size)
+        instrument.call_finished('get_visible_satellites_batch', started)
+    return visible
+
+
+def rho_rho2(pos_sph2, sats_cds, distances, display=False, tol=1e-6, max_iter=10, full_output=False,
+             instrument=None):
     """
     :param pos_sph2: [psi, lam] radians - approximate position
     :param sats_cds: [[x, y, z], [x, y, z]] rectangular - visible satellites coordinates
     :param distances: [x, x] km - measured distances to satellites from position
     :param display: bool - defines whether to display information or not
-    :return: [psi, lam] radians - more accurate position
-    """
-    for i in range(1, 11):
-        pos_sph3 = np.insert(pos_sph2, 0, [Earth.R])
-        pos_rect = spherical_to_rectangular(pos_sph3)
-        dist_approx = np.array([distance(pos_rect, sat) for sat in sats_cds])
-        A = np.array([distance_derivative(pos_sph3, sat, dist, True) for sat, dist in zip(sats_cds, dist_approx)])
-        dd = distances - dist_approx
-        dq = np.linalg.solve(A, dd)
+    :param tol: radians - iterations stop once the step norm falls below it
+    :param max_iter: int - maximum number of Newton iterations
+    :param full_output: bool - return SolverResult instead of the bare position
+    :param instrument: instrumentation.Instrument - receives every iteration and the call summary, the attached one
+        if None, see instrumentation.active
+    :return: [psi, lam] degrees - more accurate position
+    """
+    instrument = instrumentation.active(instrument, display)
+    if instrument is not None:
+        started = instrument.call_started('rho_rho2')
+
+    sats_cds = np.asarray(sats_cds, dtype=float)
+    diff, dd, A = np.empty_like(sats_cds), np.empty(len(sats_cds)), np.empty((len(sats_cds), 2))
+
+    i, converged = 0, False
+    for i in range(1, max_iter + 1):
+        range_residuals_spherical(pos_sph2, sats_cds, distances, diff, dd, A)
+        dq = least_squares_step(A, dd)
+        dq_norm = np.linalg.norm(dq)
         pos_sph2 += dq
 
-        if display:
-            print("Step:", i)
-            print("dq: {}, norm: {}".format(dq, np.linalg.norm(dq)))
-            print("Position:", np.degrees(pos_sph2), end='\n\n')
+        if instrument is not None:
+            instrument.iteration('rho_rho2', i, dq, dq_norm, np.linalg.norm(dd), pos_sph2)
+
+        if dq_norm < tol:
+            converged = True
+            break
+
+    if instrument is not None:
+        instrument.call_finished('rho_rho2', started, i, converged)
+
+    if full_output:
+        residual = np.linalg.norm(range_residuals_spherical(pos_sph2, sats_cds, distances, diff, dd, A)[0])
+        return SolverResult(np.degrees(pos_sph2), i, residual, converged)
 
     return np.degrees(pos_sph2)
 
 
-def rho_rho3(position, sats_cds, distances, display=False):
+def rho_rho3(position, sats_cds, distances, display=False, tol=1e-6, max_iter=10, full_output=False, weights=None,
+             instrument=None):
     """
     :param position: [R, psi, lam] km radians - approximate position, R isn't necessary Earth's radius
-    :param sats_cds: [[x, y, z], [x, y, z], [x, y, z]] rectangular - visible satellites coordinates
-    :param distances: [x, x, x] km - measured distances to satellites from position
+    :param sats_cds: [[x, y, z], [x, y, z], [x, y, z], ...] rectangular - visible satellites coordinates, with more
+        than three satellites the position is found in the least squares sense
+    :param distances: [x, x, x, ...] km - measured distances to satellites from position
     :param display: bool - defines whether to display information or not
-    :return: [R, psi, lam] km radians - more accurate position
+    :param tol: km - iterations stop once the step norm falls below it
+    :param max_iter: int - maximum number of Newton iterations
+    :param full_output: bool - return SolverResult instead of the bare position
+    :param weights: [w, w, w, ...] - per measurement weights, e.g. inverse variances, equal if None
+    :param instrument: instrumentation.Instrument - see rho_rho2
+    :return: [R, psi, lam] km degrees - more accurate position
     """
+    instrument = instrumentation.active(instrument, display)
+    if instrument is not None:
+        started = instrument.call_started('rho_rho3')
+
     position = spherical_to_rectangular(position)
+    sats_cds = np.asarray(sats_cds, dtype=float)
+    diff, dd, A = np.empty_like(sats_cds), np.empty(len(sats_cds)), np.empty_like(sats_cds)
 
-    for i in range(1, 11):
-        dist_approx = np.array([distance(position, sat) for sat in sats_cds])
-        A = np.array([distance_derivative(position, sat, dist, False) for sat, dist in zip(sats_cds, dist_approx)])
-        dd = distances - dist_approx
-        dq = np.linalg.solve(A, dd)
+    i, converged = 0, False
+    for i in range(1, max_iter + 1):
+        range_residuals(position, sats_cds, distances, diff, dd, A)
+        dq = least_squares_step(A, dd, weights)
+        dq_norm = np.linalg.norm(dq)
         position += dq
 
-        if display:
-            pos_sph3_rad = rectangular_to_spherical(position)
-            pos_sph3_deg = np.array([pos_sph3_rad[0], degrees(pos_sph3_rad[1]), degrees(pos_sph3_rad[2])])
-            print("Step:", i)
-            print("dq: {}, norm: {}".format(dq, np.linalg.norm(dq)))
-            print("Position:", pos_sph3_deg, end='\n\n')
+        if instrument is not None:
+            instrument.iteration('rho_rho3', i, dq, dq_norm, np.linalg.norm(dd), position)
+
+        if dq_norm < tol:
+            converged = True
+            break
+
+    if instrument is not None:
+        instrument.call_finished('rho_rho3', started, i, converged)
 
     pos_sph3_rad = rectangular_to_spherical(position)
     pos_sph3_deg = np.array([pos_sph3_rad[0], degrees(pos_sph3_rad[1]), degrees(pos_sph3_rad[2])])
+
+    if full_output:
+        residual = np.linalg.norm(range_residuals(position, sats_cds, distances, diff, dd, A)[0])
+        return SolverResult(pos_sph3_deg, i, residual, converged)
+
     return pos_sph3_deg
 
 
+def _newton_batch(function, residuals, position, tol, max_iter, weights=None, full_output=False, instrument=None):
+    """
+    Newton iterations of N independent fixes, shared by the batch solvers. Only the active fixes are iterated, a fix
+    leaves the active set once its step norm falls below tol or its system turns singular.
+    :param function: str - solver name the instrument reports
+    :param residuals: callable (positions of shape (n, m), rows) -> (measured minus computed values of shape (n, K),
+        Jacobians of shape (n, K, m)) - for the fixes rows, an index array or slice(None) for all of them
+    :param position: numpy.array of shape (N, m) - approximate positions, refined in place
+    :param tol: a fix stops iterating once its step norm falls below it
+    :param max_iter: int - maximum number of Newton iterations
+    :param weights: numpy.array of shape (N, K) - per measurement weights, equal if None
+    :param full_output: bool - also compute the residual norms at the final positions
+    :param instrument: instrumentation.Instrument - receives the call summary with per-fix iterations and
+        convergence
+    :return: ([n, ...] - iterations used by each fix, -1 for singular ones, [bool, ...] - converged fixes,
+        [residual norm, ...] if full_output else None)
+    """
+    instrument = instrumentation.active(instrument)
+    if instrument is not None:
+        started = instrument.call_started(function)
+
+    iterations = np.zeros(len(position), dtype=int)
+    active = np.arange(len(position))
+    for i in range(1, max_iter + 1):
+        # residuals fills only the first len(active) rows of its buffers as fixes converge
+        dd, A = residuals(position[active], active)
+        dq, singular = least_squares_steps(A, dd, None if weights is None else weights[active])
+        position[active] += dq
+        iterations[active] = np.where(singular, -1, i)
+        dq_norm = np.linalg.norm(dq, axis=-1)
+        if instrument is not None:
+            # one event for the whole batch, norms are per active fix
+            instrument.iteration(function, i, dq, dq_norm, np.linalg.norm(dd, axis=-1), position[active])
+
+        # singular fixes have nan steps and positions, they drop out here
+        active = active[dq_norm >= tol]
+        if len(active) == 0:
+            break
+
+    converged = iterations > 0
+    converged[active] = False
+    if instrument is not None:
+        instrument.call_finished(function, started, iterations, converged)
+
+    residual = np.linalg.norm(residuals(position, slice(None))[0], axis=-1) if full_output else None
+    return iterations, converged, residual
+
+
+def rho_rho2_batch(pos_sph2, sats_cds, distances, tol=1e-6, max_iter=10, full_output=False, instrument=None):
+    """
+    rho_rho2 for N independent fixes solved together
+    :param pos_sph2: numpy.array of shape (N, 2) radians - approximate positions [psi, lam]
+    :param sats_cds: numpy.array of shape (N, 2, 3) rectangular - two satellites coordinates per fix
+    :param distances: numpy.array of shape (N, 2) km - measured distances to satellites
+    :param tol: radians - a fix stops iterating once its step norm falls below it
+    :param max_iter: int - maximum number of Newton iterations
+    :param full_output: bool - return SolverResult of per-fix arrays instead of (positions, iterations)
+    :param instrument: instrumentation.Instrument - receives the call summary with per-fix iterations and
+        convergence, see rho_rho2
+    :return: ([[psi, lam], ...] degrees - more accurate positions, [n, ...] - iterations used by each fix, -1 for
+        fixes whose system turned singular, their positions are nan)
+    """
+    pos_sph2 = np.array(pos_sph2, dtype=float)
+    sats_cds = np.asarray(sats_cds, dtype=float)
+    distances = np.asarray(distances, dtype=float)
+    diff_buf, dd_buf, A_buf = np.empty_like(sats_cds), np.empty_like(distances), np.empty(distances.shape + (2,))
+
+    def residuals(position, rows):
+        n = len(position)
+        return range_residuals_spherical(position, sats_cds[rows], distances[rows], diff_buf[:n], dd_buf[:n],
+                                         A_buf[:n])
+
+    iterations, converged, residual = _newton_batch('rho_rho2_batch', residuals, pos_sph2, tol, max_iter,
+                                                    full_output=full_output, instrument=instrument)
+    if full_output:
+        return SolverResult(np.degrees(pos_sph2), iterations, residual, converged)
+
+    return np.degrees(pos_sph2), iterations
+
+
+def rho_rho3_batch(position, sats_cds, distances, tol=1e-6, max_iter=10, weights=None, full_output=False,
+                   instrument=None):
+    """
+    rho_rho3 for N independent fixes solved together
+    :param position: numpy.array of shape (N, 3) km radians - approximate positions [R, psi, lam]
+    :param sats_cds: numpy.array of shape (N, K, 3), K >= 3, rectangular - satellites coordinates per fix
+    :param distances: numpy.array of shape (N, K) km - measured distances to satellites
+    :param tol: km - a fix stops iterating once its step norm falls below it
+    :param max_iter: int - maximum number of Newton iterations
+    :param weights: numpy.array of shape (N, K) - per measurement weights, equal if None
+    :param full_output: bool - return SolverResult of per-fix arrays instead of (positions, iterations)
+    :param instrument: instrumentation.Instrument - receives the call summary with per-fix iterations and
+        convergence, see rho_rho2
+    :return: ([[R, psi, lam], ...] km degrees - more accurate positions, [n, ...] - iterations used by each fix, -1
+        for fixes whose system turned singular, their positions are nan)
+    """
+    position = spherical_to_rectangular(np.asarray(position, dtype=float).reshape(-1, 3))
+    sats_cds = np.asarray(sats_cds, dtype=float)
+    distances = np.asarray(distances, dtype=float)
+    if weights is not None:
+        weights = np.broadcast_to(np.asarray(weights, dtype=float), distances.shape)
+    diff_buf, dd_buf, A_buf = np.empty_like(sats_cds), np.empty_like(distances), np.empty_like(sats_cds)
+
+    def residuals(position, rows):
+        n = len(position)
+        return range_residuals(position, sats_cds[rows], distances[rows], diff_buf[:n], dd_buf[:n], A_buf[:n])
+
+    iterations, converged, residual = _newton_batch('rho_rho3_batch', residuals, position, tol, max_iter, weights,
+                                                    full_output, instrument)
+    pos_sph3 = rectangular_to_spherical(position)
+    pos_sph3[:, 1:] = np.degrees(pos_sph3[:, 1:])
+
+    if full_output:
+        return SolverResult(pos_sph3, iterations, residual, converged)
+
+    return pos_sph3, iterations
+
+
 def get_transition_matrix(position, sats_cds, distances):
     """
     :param position: [psi, lam] radians
     :param sats_cds: [[x, y, z], [x, y, z]] rectangular
     :param distances: [x, x] km
-    :return: M = [[a, b], [c, d]] such that [pos1 pos2] = M*[pos0 pos1]
+    :return: M = [[a, b], [c, d]] such that [pos1 pos2] = M*[pos0 pos1], positions in radians
     """
-    position1 = rho_rho2(np.copy(position), sats_cds, distances[0], display=False)
-    position2 = rho_rho2(np.copy(position1), sats_cds, distances[1], display=False)
+    # rho_rho2 answers in degrees, the whole system is in radians
+    position1 = np.radians(rho_rho2(np.copy(position), sats_cds, distances[0], display=False))
+    position2 = np.radians(rho_rho2(np.copy(position1), sats_cds, distances[1], display=False))
 
     S0 = np.matrix.transpose(np.array((position, position1)))
     S1 = np.matrix.transpose(np.array((position1, position2)))
 
-    # S1 = M*S0
-    M = S1.dot(np.linalg.inv(S0))
+    # S1 = M*S0, so S0^T M^T = S1^T
+    M = np.linalg.solve(S0.T, S1.T).T
 
     return M
 
 
-def doppler(position, speed, sats_positions, sats_speeds, doppler_value_measured, display=False):
+def doppler(position, speed, sats_positions, sats_speeds, doppler_value_measured, display=False,
+            tol=1e-6, max_iter=10, full_output=False, weights=None, instrument=None):
     """
     :param position: [R, psi, lam] km radians
     :param speed: [xdot, ydot, zdot] ?
-    :param sats_positions: [[x, y, z], [x, y, z], [x, y, z]] - in greenwich coordinates
+    :param sats_positions: [[x, y, z], [x, y, z], [x, y, z], ...] - in greenwich coordinates, with more than three
+        satellites the position is found in the least squares sense
     :param sats_speeds: [[xdot, ydot, zdot], ...] - in greenwich coordinates
-    :param doppler_value_measured: [rhodot1, rhodot2, rhodot3] - for each satellite
+    :param doppler_value_measured: [rhodot1, rhodot2, rhodot3, ...] - for each satellite
     :param display: bool - defines whether to display information or not
+    :param tol: km - iterations stop once the step norm falls below it
+    :param max_iter: int - maximum number of Newton iterations
+    :param full_output: bool - return SolverResult instead of the bare position
+    :param weights: [w, w, w, ...] - per measurement weights, e.g. inverse variances, equal if None
+    :param instrument: instrumentation.Instrument - see rho_rho2
     :return: [R, psi, lam] km radians - more accurate position
     """
+    instrument = instrumentation.active(instrument, display)
+    if instrument is not None:
+        started = instrument.call_started('doppler')
+
     position = spherical_to_rectangular(position)
+    speed = np.asarray(speed, dtype=float)
+    sats_positions = np.asarray(sats_positions, dtype=float)
+    sats_speeds = np.asarray(sats_speeds, dtype=float)
+    doppler_value_measured = np.asarray(doppler_value_measured, dtype=float)
+    buffers = (np.empty_like(sats_positions), np.empty_like(sats_positions), np.empty(len(sats_positions)),
+               np.empty(len(sats_positions)), np.empty_like(sats_positions))
 
-    for i in range(1, 11):
-        sats_dists = [distance(position, sat_pos) for sat_pos in sats_positions]
-        doppler_value_computed = np.array([rho_dot(position, sat_pos, speed, sat_speed, sat_dist)
-                                           for (sat_pos, sat_speed, sat_dist) in
-                                           zip(sats_positions, sats_speeds, sats_dists)])
-        drho_dot = doppler_value_measured - doppler_value_computed
-        B = np.array([rho_dot_derivative(position, sat_pos, speed, sat_speed, sat_dist)
-                      for (sat_pos, sat_speed, sat_dist) in zip(sats_positions, sats_speeds, sats_dists)])
-        dq = np.linalg.solve(B, drho_dot)
+    i, converged = 0, False
+    for i in range(1, max_iter + 1):
+        drho_dot, B = rho_dot_residuals(position, speed, sats_positions, sats_speeds, doppler_value_measured,
+                                        *buffers)
+        dq = least_squares_step(B, drho_dot, weights)
         dq_norm = np.linalg.norm(dq)
         position += dq
 
-        if display:
-            print("Step:", i)
-            print("dq: {}, norm: {}".format(dq, dq_norm))
-            print("Position:", np.degrees(rectangular_to_spherical(position)[1:3]), end='\n\n')
+        if instrument is not None:
+            instrument.iteration('doppler', i, dq, dq_norm, np.linalg.norm(drho_dot), position)
+
+        if dq_norm < tol:
+            converged = True
+            break
 
-        # if dq_norm < 1e-6:
-        #     break
+    if instrument is not None:
+        instrument.call_finished('doppler', started, i, converged)
+
+    if full_output:
+        drho_dot, _ = rho_dot_residuals(position, speed, sats_positions, sats_speeds, doppler_value_measured,
+                                        *buffers)
+        residual = np.linalg.norm(drho_dot)
+        return SolverResult(rectangular_to_spherical(position), i, residual, converged)
 
     return rectangular_to_spherical(position)
+
+
+def doppler_batch(position, speed, sats_positions, sats_speeds, doppler_value_measured, tol=1e-6, max_iter=10,
+                  weights=None, full_output=False, instrument=None):
+    """
+    doppler for N independent fixes solved together
+    :param position: numpy.array of shape (N, 3) km radians - approximate positions [R, psi, lam]
+    :param speed: numpy.array of shape (N, 3), or (3,) for all fixes - positions speeds
+    :param sats_positions: numpy.array of shape (N, K, 3), K >= 3 - satellites greenwich coordinates per fix
+    :param sats_speeds: numpy.array of shape (N, K, 3) - satellites greenwich speeds per fix
+    :param doppler_value_measured: numpy.array of shape (N, K) - rho_dot measured for each satellite
+    :param tol: km - a fix stops iterating once its step norm falls below it
+    :param max_iter: int - maximum number of Newton iterations
+    :param weights: numpy.array of shape (N, K) - per measurement weights, equal if None
+    :param full_output: bool - return SolverResult of per-fix arrays instead of (positions, iterations)
+    :param instrument: instrumentation.Instrument - see rho_rho3_batch
+    :return: ([[R, psi, lam], ...] km radians - more accurate positions, [n, ...] - iterations used by each fix, -1
+        for fixes whose system turned singular, their positions are nan)
+    """
+    position = spherical_to_rectangular(np.asarray(position, dtype=float).reshape(-1, 3))
+    sats_positions = np.asarray(sats_positions, dtype=float)
+    sats_speeds = np.asarray(sats_speeds, dtype=float)
+    measured = np.asarray(doppler_value_measured, dtype=float)
+    speed = np.broadcast_to(np.asarray(speed, dtype=float), position.shape)
+    if weights is not None:
+        weights = np.broadcast_to(np.asarray(weights, dtype=float), measured.shape)
+    buffers = (np.empty_like(sats_positions), np.empty_like(sats_positions), np.empty_like(measured),
+               np.empty_like(measured), np.empty_like(sats_positions))
+
+    def residuals(position, rows):
+        n = len(position)
+        return rho_dot_residuals(position, speed[rows], sats_positions[rows], sats_speeds[rows], measured[rows],
+                                 *[buffer[:n] for buffer in buffers])
+
+    iterations, converged, residual = _newton_batch('doppler_batch', residuals, position, tol, max_iter, weights,
+                                                    full_output, instrument)
+    if full_output:
+        return SolverResult(rectangular_to_spherical(position), iterations, residual, converged)
+
+    return rectangular_to_spherical(position), iterations
+
+
+def doppler_pass(position, speed, sats_positions, sats_speeds, doppler_value_measured, distances=None,
+                 weights=None, range_weights=None, bias=False, tol=1e-6, max_iter=10, full_output=False,
+                 instrument=None):
+    """
+    One fix of a static position from the rho_dot and range measurements of T epochs, e.g. a whole pass, solved as
+    a single Gauss-Newton problem. Rows are the rho_dot_derivative and distance_derivative ones, from the fused
+    kernels. With bias every epoch also gets its own unknown rho_dot offset (a receiver frequency offset that
+    drifts), eliminated from the normal equations epoch by epoch, so the cost stays linear in T.
+    :param position: [R, psi, lam] km radians - approximate position
+    :param speed: [xdot, ydot, zdot] - position speed
+    :param sats_positions: numpy.array of shape (T, K, 3) - satellites greenwich coordinates per epoch
+    :param sats_speeds: numpy.array of shape (T, K, 3) - satellites greenwich speeds per epoch
+    :param doppler_value_measured: numpy.array of shape (T, K) - rho_dot measured, nan where not measured
+    :param distances: numpy.array of shape (T, K) km - distances measured, nan where not measured, rho_dot only if None
+    :param weights: numpy.array broadcast to (T, K) - rho_dot weights, e.g. inverse variances, equal if None
+    :param range_weights: numpy.array broadcast to (T, K) - distances weights in the same units, equal if None
+    :param bias: bool - estimate a rho_dot offset per epoch
+    :param tol: km - iterations stop once the step norm falls below it
+    :param max_iter: int - maximum number of Gauss-Newton iterations
+    :param full_output: bool - return SolverResult instead of the bare position, its residual is the weighted one
+    :param instrument: instrumentation.Instrument - see rho_rho2
+    :return: [R, psi, lam] km radians - more accurate position, with bias a tuple of it and numpy.array of shape (T,)
+        of the rho_dot offsets, 0 for epochs without rho_dot
+    """
+    instrument = instrumentation.active(instrument)
+    if instrument is not None:
+        started = instrument.call_started('doppler_pass')
+
+    position = spherical_to_rectangular(position)
+    speed = np.asarray(speed, dtype=float)
+    sats_positions = np.asarray(sats_positions, dtype=float)
+    sats_speeds = np.asarray(sats_speeds, dtype=float)
+    shape = sats_positions.shape[:-1]
+
+    # missing measurements stay in the arrays with zero weight, so every epoch keeps the same K
+    def prepare(measured, measured_weights):
+        measured = np.asarray(measured, dtype=float)
+        taken = ~np.isnan(measured)
+        measured_weights = np.ones(shape) if measured_weights is None else \
+            np.broadcast_to(np.asarray(measured_weights, dtype=float), shape)
+        return np.where(taken, measured, 0), np.where(taken, measured_weights, 0)
+
+    measured, weights = prepare(doppler_value_measured, weights)
+    doppler_buffers = (np.empty_like(sats_positions), np.empty_like(sats_positions), np.empty(shape),
+                       np.empty(shape), np.empty_like(sats_positions))
+    if distances is not None:
+        distances, range_weights = prepare(distances, range_weights)
+        range_buffers = (np.empty_like(sats_positions), np.empty(shape), np.empty_like(sats_positions))
+    offsets = np.zeros(len(sats_positions))
+    # epochs without rho_dot have no equation for their offset, it stays 0
+    epoch_weights = weights.sum(axis=-1)
+    biased = bias & (epoch_weights > 0)
+
+    def residuals():
+        drho_dot, B = rho_dot_residuals(position, speed, sats_positions, sats_speeds, measured, *doppler_buffers)
+        drho_dot -= offsets[:, np.newaxis]
+        drho_dot *= weights > 0
+        if distances is None:
+            return drho_dot, B, None, None
+        dd, A = range_residuals(position, sats_positions, distances, *range_buffers)
+        dd *= range_weights > 0
+        return drho_dot, B, dd, A
+
+    i, converged = 0, False
+    for i in range(1, max_iter + 1):
+        drho_dot, B, dd, A = residuals()
+
+        # normal equations of the position, summed over all epochs and satellites
+        weighted_B = B*weights[..., np.newaxis]
+        normal = np.einsum('tki,tkj->ij', weighted_B, B)
+        gradient = np.einsum('tki,tk->i', weighted_B, drho_dot)
+        if distances is not None:
+            weighted_A = A*range_weights[..., np.newaxis]
+            normal += np.einsum('tki,tkj->ij', weighted_A, A)
+            gradient += np.einsum('tki,tk->i', weighted_A, dd)
+
+        if bias:
+            # an offset only couples with the rho_dot rows of its epoch: the normal matrix is an arrow, its
+            # offsets block is diagonal and is eliminated by the Schur complement
+            coupling = weighted_B.sum(axis=1)
+            offsets_gradient = np.einsum('tk,tk->t', weights, drho_dot)
+            scale = np.where(biased, 1/np.where(biased, epoch_weights, 1), 0)
+            normal -= np.einsum('ti,t,tj->ij', coupling, scale, coupling)
+            gradient -= np.einsum('ti,t,t->i', coupling, scale, offsets_gradient)
+
+        dq = np.linalg.solve(normal, gradient)
+        if bias:
+            offsets += scale*(offsets_gradient - coupling.dot(dq))
+        dq_norm = np.linalg.norm(dq)
+        position += dq
+
+        if instrument is not None:
+            residual_norm = np.linalg.norm(drho_dot) if dd is None else np.hypot(np.linalg.norm(drho_dot),
+                                                                                np.linalg.norm(dd))
+            instrument.iteration('doppler_pass', i, dq, dq_norm, residual_norm, position)
+
+        if dq_norm < tol:
+            converged = True
+            break
+
+    if instrument is not None:
+        instrument.call_finished('doppler_pass', started, i, converged)
+
+    result = rectangular_to_spherical(position)
+    if full_output:
+        drho_dot, _, dd, _ = residuals()
+        residual = np.sum(weights*drho_dot**2) + (0 if dd is None else np.sum(range_weights*dd**2))
+        result = SolverResult(result, i, np.sqrt(residual), converged)
+
+    return (result, offsets) if bias else result
+
+
+def doppler_stream(records, position, constellation=None, speed=(0, 0, 0), chunk_size=256, tol=1e-6, max_iter=10,
+                   instrument=None):
+    """
+    :param records: iterable of (when, doppler_values_measured) - epoch in any format minutes_since_spring_equinox
+        accepts and [rhodot, ...] for every satellite of the constellation, nan for satellites not tracked
+    :param position: [R, psi, lam] km radians - approximate position for the first fix
+    :param constellation: Constellation or EphemerisTable the measurements refer to, all_constellation by default
+    :param speed: [xdot, ydot, zdot] - position speed
+    :param chunk_size: int - records read and propagated together, bounds the memory used
+    :param tol: km - see doppler
+    :param max_iter: int - see doppler
+    :param instrument: instrumentation.Instrument - passed to every doppler call
+    :return: generator of (when, SolverResult) - one per record, each solve starts from the last converged fix,
+        records with less than 3 satellites tracked or a singular geometry give a nan position and converged False
+    """
+    if constellation is None:
+        constellation = registry.get('all')
+
+    records = iter(records)
+    speed = np.asarray(speed, dtype=float)
+    position = np.asarray(position, dtype=float)
+
+    while True:
+        chunk = list(islice(records, chunk_size))
+        if not chunk:
+            return
+
+        minutes = minutes_since_spring_equinox([when for when, _ in chunk])
+        sats_positions, sats_speeds = constellation.states_greenwich(minutes)
+
+        for k, (when, doppler_value_measured) in enumerate(chunk):
+            doppler_value_measured = np.asarray(doppler_value_measured, dtype=float)
+            tracked = ~np.isnan(doppler_value_measured)
+            if np.count_nonzero(tracked) < 3:
+                yield when, SolverResult(np.full(3, np.nan), 0, np.nan, False)
+                continue
+
+            try:
+                result = doppler(position, speed, sats_positions[tracked, k], sats_speeds[tracked, k],
+                                 doppler_value_measured[tracked], tol=tol, max_iter=max_iter, full_output=True,
+                                 instrument=instrument)
+            except np.linalg.LinAlgError:
+                # a degenerate geometry fails this record only, the stream goes on from the last converged fix
+                yield when, SolverResult(np.full(3, np.nan), 0, np.nan, False)
+                continue
+            if result.converged:
+                position = result.position
+            yield when, result
+
+
+# Same batch APIs reading their inputs from and writing their outputs to columnar datasets, see storage.py.
+# Inputs are memory-mapped and processed chunk_size rows at a time, so files may be larger than memory.
+
+def get_visible_satellites_file(observers_path, when, output_path, constellation=None, chunk_size=65536):
+    """
+    :param observers_path: dataset with a 'where' column of shape (M, 2) radians
+    :param when: epochs, see get_visible_satellites_batch
+    :param output_path: a 'visibility' dataset with a 'visible' column of shape (M, T, S) is written there
+    """
+    observers, _ = load_columns(observers_path)
+    epochs = np.atleast_1d(minutes_since_spring_equinox(when))
+    satellites = len(registry.get('all') if constellation is None else constellation)
+    output = create_columns(output_path, 'visibility', len(observers['where']), {'minutes': epochs.tolist()},
+                            visible=(bool, (len(epochs), satellites)))
+
+    for start, chunk in iter_chunks(observers, chunk_size):
+        output['visible'][start:start + len(chunk['where'])] = \
+            get_visible_satellites_batch(chunk['where'], when, constellation)
+    output['visible'].flush()
+
+
+def rho_rho3_file(measurements_path, output_path, position, chunk_size=65536, **options):
+    """
+    :param measurements_path: dataset with 'sats_cds' (N, K, 3) and 'distances' (N, K) columns, and optionally
+        'weights' (N, K)
+    :param output_path: a 'fixes' dataset with 'position' (N, 3) and 'iterations' (N,) columns is written there
+    :param position: [R, psi, lam] km radians - approximate position, the same for all fixes
+    :param options: tol, max_iter, weights - see rho_rho3_batch, (N, K) weights are split into chunks like the
+        columns, given ones take precedence over the 'weights' column
+    """
+    measurements, _ = load_columns(measurements_path)
+    rows = len(measurements['distances'])
+    output = create_columns(output_path, 'fixes', rows, position=(float, (3,)), iterations=(int, ()))
+    weights = options.pop('weights', measurements.pop('weights', None))
+    if weights is not None:
+        weights = np.asarray(weights, dtype=float)
+    per_fix = weights is not None and weights.ndim == 2 and len(weights) == rows
+
+    for start, chunk in iter_chunks(measurements, chunk_size):
+        stop = start + len(chunk['distances'])
+        guess = np.broadcast_to(position, (stop - start, 3))
+        output['position'][start:stop], output['iterations'][start:stop] = \
+            rho_rho3_batch(guess, chunk['sats_cds'], chunk['distances'],
+                           weights=weights[start:stop] if per_fix else weights, **options)
+    for column in output.values():
+        column.flush()
+
+
+def doppler_file(measurements_path, output_path, position, constellation=None, chunk_size=65536, **options):
+    """
+    :param measurements_path: dataset with 'when' (N,) and 'rho_dot' (N, S) columns, see doppler_stream
+    :param output_path: a 'fixes' dataset with 'position' (N, 3) km radians, 'iterations' (N,) and 'converged' (N,)
+        columns is written there
+    :param position: [R, psi, lam] km radians - approximate position for the first fix
+    :param options: speed, tol, max_iter - see doppler_stream
+    """
+    measurements, _ = load_columns(measurements_path)
+    rows = len(measurements['when'])
+    output = create_columns(output_path, 'fixes', rows,
+                            position=(float, (3,)), iterations=(int, ()), converged=(bool, ()))
+
+    records = ((when, rho_dot) for _, chunk in iter_chunks(measurements, chunk_size)
+               for when, rho_dot in zip(chunk['when'], chunk['rho_dot']))
+    fixes = doppler_stream(records, position, constellation, chunk_size=chunk_size, **options)
+    for k, (_, result) in enumerate(fixes):
+        output['position'][k], output['iterations'][k], output['converged'][k] = \
+            result.position, result.iterations, result.converged
+    for column in output.values():
+        column.flush()
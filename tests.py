@@ -1,4 +1,34 @@
-from tasks import *
+import asyncio
+import itertools
+import json
+import subprocess
+import sys
+import tempfile
+from datetime import datetime, timezone, timedelta
+from math import radians
+
+import numpy as np
+
+from earth import Earth
+from translations import spherical_to_rectangular, equatorial_to_greenwich, earth_rotation
+from satellites import TransitSatellite, GPSSatellite, Constellation
+from utils import GroundStation, minutes_since_spring_equinox, distance, distance_derivative, rho_dot, \
+    rho_dot_derivative, range_residuals, range_residuals_spherical, rho_dot_residuals
+from tasks import get_visible_satellites, get_visible_satellites_batch, get_visible_satellites_file, rho_rho2, \
+    rho_rho3, rho_rho2_batch, rho_rho3_batch, rho_rho3_file, doppler, doppler_pass, doppler_file, doppler_stream, \
+    get_transition_matrix
+from tasks import transit_sats, gps_sats, transit_constellation, gps_constellation, all_constellation
+from ephemeris import EphemerisTable
+from tracking import Tracker
+from runner import run_sharded, visibility_job, rho_rho3_job
+from storage import save_columns, load_columns
+import benchmarks
+import instrumentation
+import registry
+from passes import predict_passes
+from coverage_index import CoverageIndex
+from service import Service
+from geometry import dilution_of_precision, best_subset, doppler_jacobian, SubsetSelector
 
 
 def test_satellites_visibility():
@@ -67,6 +97,230 @@ def test_satellites_visibility():
     assert get_visible_satellites(where, when, display=True) == [[2], [4, 5]]
 
 
+def test_satellites_visibility_batch():
+    msk = timezone(timedelta(hours=3))
+    when = [datetime(2015, 2, 15, 11, 10, 0, 0, msk), datetime(2015, 6, 11, 23, 0, 0, 0, msk),
+            datetime(2015, 10, 27, 18, 5, 0, 0, msk)]
+    where = np.radians([[85, 20], [70, 50], [-30, 140], [0, -75]])
+    visible = get_visible_satellites_batch(where, when)
+    assert visible.shape == (len(where), len(when), len(transit_sats) + len(gps_sats))
+
+    for i, point in enumerate(where):
+        for j, moment in enumerate(when):
+            transit_vis, gps_vis = get_visible_satellites(point, moment)
+            indices = np.flatnonzero(visible[i, j]) + 1
+            assert list(indices[indices <= len(transit_sats)]) == transit_vis
+            assert list(indices[indices > len(transit_sats)] - len(transit_sats)) == gps_vis
+
+
+def test_minutes_since_spring_equinox():
+    msk = timezone(timedelta(hours=3))
+    assert minutes_since_spring_equinox(datetime(2015, 3, 22, 0, 0)) == 0
+    assert minutes_since_spring_equinox(datetime(2015, 3, 22, 3, 1, 30, 0, msk)) == 1.5
+    assert minutes_since_spring_equinox(datetime(2015, 1, 1)) == 285*1440
+    # leap day between the equinoxes of 2015 and 2016
+    assert minutes_since_spring_equinox(datetime(2016, 3, 1)) == 345*1440
+
+    when = datetime(2015, 6, 11, 20, 0, 0, 0, timezone.utc)
+    timestamps = when.timestamp() + 0.1*np.arange(10)
+    minutes = minutes_since_spring_equinox(timestamps)
+    assert np.allclose(minutes, minutes_since_spring_equinox(when) + np.arange(10)/600)
+    datetimes64 = np.array(['2015-06-11T20:00:06'], dtype='datetime64[ms]')
+    assert np.allclose(minutes_since_spring_equinox(datetimes64), minutes[0] + 0.1)
+    assert np.allclose(minutes_since_spring_equinox([when, when + timedelta(minutes=5)]), minutes[0] + [0, 5])
+
+
+def test_vectorized_propagation():
+    minutes = np.arange(0, 1440, 7.5)
+    for sat in transit_sats + gps_sats:
+        coordinates = sat.coordinates_greenwich(minutes)
+        speeds = sat.speed_greenwich(minutes)
+        assert coordinates.shape == speeds.shape == (len(minutes), 3)
+        for k in [0, 17, len(minutes) - 1]:
+            assert np.linalg.norm(coordinates[k] - sat.coordinates_greenwich(minutes[k])) < 1e-9
+            assert np.linalg.norm(speeds[k] - sat.speed_greenwich(minutes[k])) < 1e-9
+        assert np.allclose(np.linalg.norm(coordinates, axis=1), sat.R)
+
+
+def test_constellation():
+    minutes = np.arange(0, 1440, 7.5)
+    for constellation, sats in [(transit_constellation, transit_sats), (gps_constellation, gps_sats)]:
+        coordinates = constellation.coordinates_greenwich(minutes)
+        speeds = constellation.speed_greenwich(minutes)
+        assert coordinates.shape == speeds.shape == (len(sats), len(minutes), 3)
+        for k, sat in enumerate(sats):
+            assert np.allclose(coordinates[k], sat.coordinates_greenwich(minutes))
+            assert np.allclose(speeds[k], sat.speed_greenwich(minutes))
+            assert np.allclose(constellation[k].coordinates_greenwich(minutes), sat.coordinates_greenwich(minutes))
+        assert constellation.coordinates_greenwich(minutes[3]).shape == (len(sats), 3)
+
+        # a time of its own for every satellite
+        picked = np.array([0, 3, 3, len(sats) - 1])
+        times = minutes[[5, 9, 40, 100]]
+        positions, speeds = constellation.states_greenwich(times, picked)
+        assert np.allclose(positions, [sats[k].coordinates_greenwich(t) for k, t in zip(picked, times)])
+        assert np.allclose(speeds, [sats[k].speed_greenwich(t) for k, t in zip(picked, times)])
+
+
+def test_earth_rotation():
+    minutes = np.arange(0, 1440, 7.5)
+    rotation = earth_rotation(minutes)
+    assert earth_rotation(np.arange(0, 1440, 7.5)) is rotation
+    vectors = np.random.default_rng(0).normal(size=(len(minutes), 3))
+    gamma = Earth.w_sun*minutes + Earth.w_self*minutes
+    assert np.allclose(rotation.to_greenwich(vectors), equatorial_to_greenwich(vectors, gamma))
+    assert np.allclose(np.einsum('tij,tj->ti', rotation.matrices(), vectors), rotation.to_greenwich(vectors))
+    assert np.allclose(np.einsum('tij,tj->ti', rotation.matrices(False), vectors), rotation.to_equatorial(vectors))
+
+    positions, speeds = all_constellation.states_greenwich(minutes)
+    assert np.allclose(positions, all_constellation.coordinates_greenwich(minutes))
+    assert np.allclose(speeds, all_constellation.speed_greenwich(minutes))
+    table = EphemerisTable.build(all_constellation, 0, 1440)
+    positions, speeds = table.states_greenwich(minutes + 0.3)
+    assert np.allclose(positions, table.coordinates_greenwich(minutes + 0.3))
+    assert np.allclose(speeds, table.speed_greenwich(minutes + 0.3))
+
+
+def test_compact_satellites():
+    satellite = TransitSatellite(30, 40)
+    assert not hasattr(satellite, '__dict__')
+    assert np.allclose(satellite.coordinates_greenwich(100), transit_constellation[0].coordinates_greenwich(100))
+
+    # propagation doesn't pull in the solvers or the constellation registry
+    loaded = subprocess.run([sys.executable, '-c', 'import sys, satellites; print(*sorted(sys.modules))'],
+                            capture_output=True, text=True, check=True).stdout.split()
+    assert not {'tasks', 'registry', 'storage', 'utils'} & set(loaded)
+
+
+def test_ground_station():
+    rng = np.random.default_rng(0)
+    where = np.column_stack([rng.uniform(-1.5, 1.5, 50), rng.uniform(-3, 3, 50)])
+    when = [datetime(2015, 6, 11, 20, 0, 0, 0, timezone.utc) + timedelta(minutes=10*k) for k in range(6)]
+    stations = GroundStation(where)
+    assert (get_visible_satellites_batch(stations, when) == get_visible_satellites_batch(where, when)).all()
+    assert get_visible_satellites(GroundStation(where[7]), when[0]) == get_visible_satellites(where[7], when[0])
+
+    minutes = minutes_since_spring_equinox(when[0])
+    sats_positions, sats_speeds = all_constellation.states_greenwich(minutes)
+    station = GroundStation(np.array([Earth.R, radians(70), radians(50)]))
+    assert np.allclose(station.distances(sats_positions), [distance(station, sat) for sat in sats_positions])
+    assert np.allclose(station.range_rates(sats_positions, sats_speeds),
+                       [rho_dot(station.position, sat, np.zeros(3), speed, distance(station, sat))
+                        for sat, speed in zip(sats_positions, sats_speeds)])
+
+    # east, north, up is a rotation, up is the normal
+    assert np.allclose(stations.enu @ stations.enu.swapaxes(-1, -2), np.eye(3))
+    local = station.to_enu(sats_positions)
+    assert np.allclose(np.linalg.norm(local, axis=-1), station.distances(sats_positions))
+    assert np.allclose(local[:, 2], (sats_positions - station.position) @ station.normal)
+    east, north, up = station.to_enu(spherical_to_rectangular(np.array([[Earth.R, radians(75), radians(50)]])))[0]
+    assert abs(east) < 1e-9 and north > 0 > up
+
+
+def test_registry():
+    registry.register('test', {'orbit': {'i': 60, 'R': 15000, 'w': 2},
+                               'satellites': [{'omega_big': 45, 'tau': 100, 'omega': 30},
+                                              {'omega_big': 90, 'tau': 85}]})
+    registry.register('test_all', {'model': 'union', 'include': ['gps', 'test']})
+    try:
+        constellation = registry.get('test')
+        assert registry.get('test') is constellation and len(registry.get('test_all')) == len(gps_sats) + 2
+        assert 'transit' in registry.names()
+
+        # in the orbit plane omega = 30 degrees is the same as passing the node 15 minutes earlier at 2 degrees/min
+        minutes = np.arange(0, 600, 7.5)
+        shifted = gps_sats[1].coordinates_equatorial(minutes + 15)
+        assert np.allclose(constellation.coordinates_equatorial(minutes)[0], shifted)
+        assert np.allclose(constellation[0].coordinates_equatorial(minutes), shifted)
+        assert np.allclose(registry.get('test_all').speed_equatorial(minutes)[-1],
+                           gps_sats[2].speed_equatorial(minutes - 15))
+        assert np.allclose(all_constellation.coordinates_greenwich(minutes),
+                           Constellation.from_satellites(transit_sats + gps_sats).coordinates_greenwich(minutes))
+    finally:
+        registry.unregister('test')
+        registry.unregister('test_all')
+    assert 'test' not in registry.names() and 'test_all' not in registry.names()
+
+    # the module level satellites lists are built once, with their original types, and rebuilt after a change
+    import tasks
+    assert tasks.transit_sats is tasks.transit_sats and tasks.gps_constellation is tasks.gps_constellation
+    assert all(type(sat) is TransitSatellite for sat in tasks.transit_sats)
+    assert all(type(sat) is GPSSatellite for sat in tasks.gps_sats)
+    assert {'transit_sats', 'all_constellation', 'doppler_pass'} <= set(dir(tasks))
+    names = {}
+    exec('from tasks import *', names)
+    assert names['gps_sats'] is tasks.gps_sats and 'doppler_stream' in names
+    gps_sats_before = tasks.gps_sats
+    registry.load()
+    assert tasks.gps_sats is not gps_sats_before
+    assert np.allclose(tasks.gps_sats[3].coordinates_greenwich(minutes),
+                       gps_sats_before[3].coordinates_greenwich(minutes))
+
+    # a non default orbit is kept whole, not replaced by the GPSSatellite one
+    registry.register('gps', dict(registry._definitions['gps'], orbit={'i': 55, 'R': 26560, 'w': 0.5}))
+    try:
+        assert np.allclose(Constellation.from_satellites(tasks.gps_sats).coordinates_greenwich(minutes),
+                           tasks.gps_constellation.coordinates_greenwich(minutes))
+        assert np.allclose([sat.R for sat in tasks.gps_sats], 26560)
+    finally:
+        registry.load()
+    assert all(type(sat) is GPSSatellite for sat in tasks.gps_sats)
+
+
+def test_ephemeris_table():
+    minutes = np.random.default_rng(0).uniform(0, 1440, 1000)
+    for constellation in [transit_constellation, gps_constellation]:
+        table = EphemerisTable.build(constellation, 0, 1440)
+        error = table.coordinates_greenwich(minutes) - constellation.coordinates_greenwich(minutes)
+        assert np.abs(error).max() < np.max(constellation.R*constellation.w**4/384)
+        assert np.allclose(table.speed_greenwich(minutes), constellation.speed_greenwich(minutes))
+        assert np.allclose(table.coordinates_greenwich(600), constellation.coordinates_greenwich(600))
+
+        with tempfile.TemporaryDirectory() as path:
+            table.save(path)
+            loaded = EphemerisTable.load(path)
+            assert isinstance(loaded.positions, np.memmap)
+            assert np.array_equal(loaded.coordinates_greenwich(minutes), table.coordinates_greenwich(minutes))
+            del loaded
+
+        try:
+            table.coordinates_greenwich(1441)
+            assert False
+        except ValueError:
+            pass
+
+
+def test_predict_passes():
+    where = np.radians([[85, 20], [70, 50], [-30, 140]])
+    start = datetime(2015, 6, 11, 20, 0, 0, 0, timezone.utc)
+    passes = predict_passes(where, start, 720, tol=1e-4)
+    assert np.all(passes.rise <= passes.set) and len(passes.rise) > 0
+
+    # brute force scan every 0.1 minutes, samples right at rises and sets are skipped
+    minutes = minutes_since_spring_equinox(start) + np.arange(0, 720, 0.1)
+    visible = get_visible_satellites_batch(where, start.timestamp() + 60*np.arange(0, 720, 0.1))
+    for observer, satellite, rise, set_ in zip(*passes):
+        inside = (minutes > rise + 1e-3) & (minutes < set_ - 1e-3)
+        assert np.all(visible[observer, inside, satellite])
+        visible[observer, (minutes > rise - 1e-3) & (minutes < set_ + 1e-3), satellite] = False
+    assert not np.any(visible)
+
+
+def test_coverage_index():
+    rng = np.random.default_rng(0)
+    where = np.column_stack([np.arcsin(rng.uniform(-1, 1, 20000)), rng.uniform(-np.pi, np.pi, 20000)])
+    where[:2] = np.radians([[90, 0], [-90, 180]])
+    when = [datetime(2015, 6, 11, 20, 0, 0, 0, timezone.utc) + timedelta(minutes=37*k) for k in range(6)]
+    visible = get_visible_satellites_batch(where, when)
+    # 7 and 13 degrees don't divide 360, caps crossing the 180 meridian must still reach the first column
+    for cell in [5, 7, 13]:
+        index = CoverageIndex(where, cell=np.radians(cell))
+        for t, moment in enumerate(when):
+            for satellite, observers in enumerate(index.query(moment)):
+                assert np.array_equal(observers, np.flatnonzero(visible[:, t, satellite]))
+            assert np.array_equal(index.covered(moment), visible[:, t].sum(axis=1))
+
+
 def test_rho_rho2():
     # 1
     # Объект находится в Гвинейском заливе в окрестности точки с коорднатами 0.5 градуса северной широты и 1 градус
@@ -109,6 +363,224 @@ def test_rho_rho3():
     assert np.linalg.norm(answer - np.array([7000, 0.7, -1.5])) < 1e-2
 
 
+def test_solver_convergence():
+    position = np.array([7000, radians(1), radians(-1)])
+    satellites = np.array([[8639.76, -2477.41, 4383.71],
+                           [9174.33, 2287.42, -3255.68],
+                           [8974.15, -3444.85, 2756.37]])
+    distances = np.array([5141.61, 4691.28, 4656.23])
+    result = rho_rho3(np.copy(position), satellites, distances, full_output=True)
+    assert result.converged and result.iterations < 10 and result.residual < 1e-6
+    assert np.allclose(result.position, rho_rho3(np.copy(position), satellites, distances))
+
+    result = rho_rho3(np.copy(position), satellites, distances, max_iter=1, full_output=True)
+    assert not result.converged and result.iterations == 1
+
+    position = np.radians([0.5, -1])
+    satellites = [[8676.21, -2487.86, 4305.11],
+                  [9146.41, 2280.46, -3338.07]]
+    distances = np.array([5339.75, 5101.44])
+    result = rho_rho2(position, satellites, distances, tol=1e-9, full_output=True)
+    assert result.converged and result.residual < 1e-6
+
+
+def test_solvers_without_iterations():
+    position = np.array([7000, radians(1), radians(-1)])
+    satellites = np.array([[8639.76, -2477.41, 4383.71],
+                           [9174.33, 2287.42, -3255.68],
+                           [8974.15, -3444.85, 2756.37]])
+    distances = np.array([5141.61, 4691.28, 4656.23])
+    sink = instrumentation.MetricsSink()
+    result = rho_rho3(np.copy(position), satellites, distances, max_iter=0, full_output=True, instrument=sink)
+    assert result.iterations == 0 and not result.converged
+    assert np.allclose(result.position, [7000, 1, -1])
+    result = rho_rho2(np.radians([0.5, -1]), satellites[:2], distances[:2], max_iter=0, full_output=True,
+                      instrument=sink)
+    assert result.iterations == 0 and not result.converged
+    result = doppler(position, np.zeros(3), satellites, np.ones((3, 3)), np.zeros(3), max_iter=0, full_output=True,
+                     instrument=sink)
+    assert result.iterations == 0 and not result.converged
+    assert sink.snapshot()['rho_rho3.diverged'] == 1
+
+
+def test_instrumentation():
+    position = np.array([7000, radians(1), radians(-1)])
+    satellites = np.array([[8639.76, -2477.41, 4383.71],
+                           [9174.33, 2287.42, -3255.68],
+                           [8974.15, -3444.85, 2756.37]])
+    distances = np.array([5141.61, 4691.28, 4656.23])
+    sink = instrumentation.MetricsSink()
+    result = rho_rho3(np.copy(position), satellites, distances, full_output=True, instrument=sink)
+    rho_rho3_batch(np.array([position]*4), np.array([satellites]*4), np.array([distances]*4), instrument=sink)
+    get_visible_satellites_batch(np.radians([[85, 20], [0, 0]]), [datetime(2015, 6, 11, 20, tzinfo=timezone.utc)],
+                                 instrument=sink)
+
+    metrics = sink.snapshot()
+    assert metrics['rho_rho3.calls'] == 1 and metrics['rho_rho3.converged'] == 1
+    assert metrics['rho_rho3.iterations']['total'] == result.iterations
+    assert metrics['rho_rho3.residual_norm']['count'] == result.iterations
+    assert metrics['rho_rho3_batch.iterations']['count'] == 4 and metrics['rho_rho3_batch.converged'] == 4
+    # every fix adds its norms on each iteration it is still active
+    assert metrics['rho_rho3_batch.step_norm']['count'] == metrics['rho_rho3_batch.iterations']['total']
+    assert metrics['visibility_checks'] == 2*len(all_constellation)
+    assert metrics['rho_rho3.seconds']['total'] > 0
+
+    instrumentation.attach(sink)
+    try:
+        rho_rho3(np.copy(position), satellites, distances)
+    finally:
+        instrumentation.attach(None)
+    assert sink.snapshot()['rho_rho3.calls'] == 2
+
+
+def test_rho_rho_batch():
+    positions = np.radians([[0.5, -1], [0.5, 0.5], [1, 1]])
+    satellites = np.array([[[8676.21, -2487.86, 4305.11], [9146.41, 2280.46, -3338.07]],
+                           [[8738.36, -2259.89, 4305.11], [9083.58, 2519.10, -3338.07]],
+                           [[8720.96, -2174.38, 4383.71], [9088.91, 2606.2, -3255.68]]])
+    distances = np.array([[5339.75, 5101.44], [5468.63, 4986.28], [5196.41, 5277.57]])
+    answers, iterations = rho_rho2_batch(positions, satellites, distances)
+    for k in range(len(positions)):
+        assert np.linalg.norm(answers[k] - rho_rho2(np.copy(positions[k]), satellites[k], distances[k])) < 1e-5
+    assert np.all((1 <= iterations) & (iterations <= 10))
+
+    position = np.array([7000, radians(1), radians(-1)])
+    satellites = np.array([[8639.76, -2477.41, 4383.71],
+                           [9174.33, 2287.42, -3255.68],
+                           [8974.15, -3444.85, 2756.37]])
+    distances = np.array([5141.61, 4691.28, 4656.23])
+    answers, iterations = rho_rho3_batch(np.array([position]*4), np.array([satellites]*4), np.array([distances]*4))
+    assert answers.shape == (4, 3)
+    assert np.allclose(answers, rho_rho3(np.copy(position), satellites, distances))
+    assert np.all(iterations == iterations[0]) and iterations[0] < 10
+
+    # the same satellite three times leaves the middle fix singular, the others are solved anyway
+    singular = np.array([satellites, [satellites[0]]*3, satellites])
+    answers, iterations = rho_rho3_batch(np.array([position]*3), singular, np.array([distances]*3))
+    assert list(iterations[[0, 2]]) == [iterations[0]]*2 and iterations[1] == -1
+    assert np.allclose(answers[[0, 2]], rho_rho3(np.copy(position), satellites, distances))
+    assert np.all(np.isnan(answers[1]))
+
+
+def test_fused_kernels():
+    position = spherical_to_rectangular(np.array([Earth.R, radians(70), radians(50)]))
+    speed = np.array([0.1, -0.2, 0.3])
+    sats_positions = all_constellation.coordinates_greenwich(117840)
+    sats_speeds = all_constellation.speed_greenwich(117840)
+    measured = np.arange(len(sats_positions), dtype=float)
+    dists = np.array([distance(position, sat_pos) for sat_pos in sats_positions])
+
+    buffers = (np.empty_like(sats_positions), np.empty(len(sats_positions)), np.empty_like(sats_positions))
+    residuals, jacobian = range_residuals(position, sats_positions, measured, *buffers)
+    assert np.allclose(residuals, measured - dists)
+    assert np.allclose(jacobian, [distance_derivative(position, sat_pos, dist, False)
+                                  for sat_pos, dist in zip(sats_positions, dists)])
+
+    buffers = (np.empty_like(sats_positions), np.empty(len(sats_positions)), np.empty((len(sats_positions), 2)))
+    residuals, jacobian = range_residuals_spherical(np.radians([70, 50]), sats_positions, measured, *buffers)
+    position_sph = np.array([Earth.R, radians(70), radians(50)])
+    assert np.allclose(residuals, measured - dists)
+    assert np.allclose(jacobian, [distance_derivative(position_sph, sat_pos, dist, True)
+                                  for sat_pos, dist in zip(sats_positions, dists)])
+
+    buffers = (np.empty_like(sats_positions), np.empty_like(sats_positions), np.empty(len(sats_positions)),
+               np.empty(len(sats_positions)), np.empty_like(sats_positions))
+    residuals, jacobian = rho_dot_residuals(position, speed, sats_positions, sats_speeds, measured, *buffers)
+    assert np.allclose(residuals, measured - np.array([rho_dot(position, sat_pos, speed, sat_speed, dist)
+                                                       for sat_pos, sat_speed, dist in
+                                                       zip(sats_positions, sats_speeds, dists)]))
+    assert np.allclose(jacobian, [rho_dot_derivative(position, sat_pos, speed, sat_speed, dist)
+                                  for sat_pos, sat_speed, dist in zip(sats_positions, sats_speeds, dists)])
+
+
+def test_run_sharded():
+    where = np.radians([[85, 20], [70, 50], [-30, 140], [0, -75], [10, 10]])
+    when = [datetime(2015, 2, 15, 8, 10, 0, 0, timezone.utc), datetime(2015, 6, 11, 20, 0, 0, 0, timezone.utc)]
+    visible, reports = run_sharded(visibility_job, where, when=when, shards=3, processes=2)
+    assert np.array_equal(visible, get_visible_satellites_batch(where, when))
+    assert [report.index for report in reports] == [0, 1, 2]
+    assert sum(report.size for report in reports) == len(where)
+
+    position = np.array([[7000, radians(1), radians(-1)]]*5)
+    satellites = np.array([[[8639.76, -2477.41, 4383.71],
+                            [9174.33, 2287.42, -3255.68],
+                            [8974.15, -3444.85, 2756.37]]]*5)
+    distances = np.array([[5141.61, 4691.28, 4656.23]]*5)
+    (answers, iterations), _ = run_sharded(rho_rho3_job, position, satellites, distances, shards=2, processes=2)
+    assert np.allclose(answers, rho_rho3_batch(position, satellites, distances)[0])
+
+    visible, reports = run_sharded(visibility_job, np.empty((0, 2)), when=when)
+    assert visible.shape == (0, len(when), len(all_constellation)) and reports == []
+    (answers, iterations), _ = run_sharded(rho_rho3_job, position[:0], satellites[:0], distances[:0])
+    assert answers.shape == (0, 3) and iterations.shape == (0,)
+
+
+def test_columnar_files():
+    with tempfile.TemporaryDirectory() as path:
+        all_constellation.save(path + '/satellites')
+        loaded = Constellation.load(path + '/satellites')
+        assert np.array_equal(loaded.coordinates_greenwich(1000), all_constellation.coordinates_greenwich(1000))
+
+        where = np.radians([[85, 20], [70, 50], [-30, 140], [0, -75], [10, 10]])
+        when = [datetime(2015, 2, 15, 8, 10, 0, 0, timezone.utc), datetime(2015, 6, 11, 20, 0, 0, 0, timezone.utc)]
+        save_columns(path + '/observers', 'observers', where=where)
+        get_visible_satellites_file(path + '/observers', when, path + '/visibility', chunk_size=2)
+        columns, meta = load_columns(path + '/visibility')
+        assert meta['kind'] == 'visibility' and meta['rows'] == len(where)
+        assert np.array_equal(columns['visible'], get_visible_satellites_batch(where, when))
+
+        position = np.array([7000, radians(1), radians(-1)])
+        satellites = np.array([[[8639.76, -2477.41, 4383.71],
+                                [9174.33, 2287.42, -3255.68],
+                                [8974.15, -3444.85, 2756.37]]]*5)
+        distances = np.array([[5141.61, 4691.28, 4656.23]]*5)
+        save_columns(path + '/ranges', 'measurements', sats_cds=satellites, distances=distances)
+        rho_rho3_file(path + '/ranges', path + '/range_fixes', position, chunk_size=2)
+        columns, _ = load_columns(path + '/range_fixes')
+        assert np.allclose(columns['position'], rho_rho3(np.copy(position), satellites[0], distances[0]))
+
+        # per-fix weights follow the chunks, given or stored as a column
+        satellites = np.concatenate([satellites, satellites[:, :1]], axis=1)
+        distances = np.concatenate([distances, distances[:, :1] + 10], axis=1)
+        weights = np.tile([1., 1., 1., 1e-3], (5, 1))
+        weights[3, 3] = 1
+        expected = [rho_rho3(np.copy(position), satellites[k], distances[k], weights=weights[k]) for k in range(5)]
+        save_columns(path + '/ranges', 'measurements', sats_cds=satellites, distances=distances)
+        rho_rho3_file(path + '/ranges', path + '/range_fixes', position, chunk_size=2, weights=weights)
+        assert not np.allclose(expected[3], expected[0])
+        assert np.allclose(load_columns(path + '/range_fixes')[0]['position'], expected)
+        save_columns(path + '/weighted', 'measurements', sats_cds=satellites, distances=distances, weights=weights)
+        rho_rho3_file(path + '/weighted', path + '/weighted_fixes', position, chunk_size=2)
+        assert np.allclose(load_columns(path + '/weighted_fixes')[0]['position'], expected)
+
+        when = np.datetime64('2015-06-11T20:00') + np.arange(5)*np.timedelta64(10, 's')
+        minutes = minutes_since_spring_equinox(when)
+        rpoint_rect = spherical_to_rectangular(np.array([Earth.R, radians(70), radians(50)]))
+        diff = rpoint_rect - all_constellation.coordinates_greenwich(minutes)
+        rho_dot_real = np.einsum('ijk,ijk->ji', diff, -all_constellation.speed_greenwich(minutes))
+        rho_dot_real /= np.linalg.norm(diff, axis=-1).T
+        rho_dot_real[:, ~get_visible_satellites_batch(np.radians([[70, 50]]), when)[0, 0]] = np.nan
+        save_columns(path + '/dopplers', 'measurements', when=when, rho_dot=rho_dot_real)
+        doppler_file(path + '/dopplers', path + '/doppler_fixes', np.array([Earth.R, radians(61.5), radians(57.5)]),
+                     chunk_size=2)
+        columns, _ = load_columns(path + '/doppler_fixes')
+        assert columns['converged'].all()
+        assert np.allclose(np.degrees(columns['position'][:, 1:]), [70, 50])
+        del columns, loaded
+
+
+def test_benchmarks():
+    results = benchmarks.run(batch_sizes=(3,), constellation_sizes=(4,), repeat=1)
+    names = {result['name'] for result in results}
+    assert {'coordinates_greenwich', 'get_visible_satellites', 'rho_rho2', 'rho_rho3', 'doppler',
+            'get_transition_matrix'} <= names
+    assert all(result['rate'] > 0 and result['peak_memory'] > 0 for result in results)
+    # the batch solvers workloads converge instead of timing max_iter iterations
+    solvers = [result for result in results if result['name'] in ('rho_rho2_batch', 'rho_rho3_batch')]
+    assert len(solvers) == 2 and all(result['mean_iterations'] < 8 for result in solvers)
+    assert all(ratio == 1 for *_, ratio in benchmarks.compare(results, results))
+
+
 def test_transition_matrix():
     # 1
     coords = np.radians([-1, 1])
@@ -147,6 +619,40 @@ def test_transition_matrix():
     print(matrix9, sep='\n\n')
 
 
+def test_tracker():
+    satellites = np.array([[8738.36, -2259.89, 4305.11],
+                           [9083.58, 2519.1, -3338.07]])
+    transition = np.array([[1, 0.02],
+                           [-0.02, 1]])
+    real = np.radians([1, 0.5])
+    tracker = Tracker(real + np.radians([0.3, -0.2]), covariance=radians(0.5)**2, transition=transition,
+                      process_noise=1e-12)
+    resolves = 0
+    for _ in range(20):
+        real = transition.dot(real)
+        distances = np.linalg.norm(satellites - spherical_to_rectangular(np.insert(real, 0, Earth.R)), axis=1)
+        tracker.predict()
+        resolves += not tracker.update_ranges(satellites, distances, gate=9.21)
+    assert resolves <= 1
+    assert np.linalg.norm(np.degrees(tracker.state - real)) < 1e-4
+
+    real = np.radians([70, 50])
+    minutes = minutes_since_spring_equinox(datetime(2015, 6, 11, 20, 0, 0, 0, timezone.utc)) + np.arange(10)
+    tracker = Tracker(real + np.radians([0.3, -0.3]), covariance=radians(0.5)**2)
+    real_rect = spherical_to_rectangular(np.insert(real, 0, Earth.R))
+    # visible from there: GPS 2, 3 and Transit 3, 4, see test_doppler
+    for minute in minutes:
+        sats_positions = gps_constellation.coordinates_greenwich(minute)[[1, 2]]
+        sats_positions = np.vstack([sats_positions, transit_constellation.coordinates_greenwich(minute)[[2, 3]]])
+        sats_speeds = gps_constellation.speed_greenwich(minute)[[1, 2]]
+        sats_speeds = np.vstack([sats_speeds, transit_constellation.speed_greenwich(minute)[[2, 3]]])
+        diff = real_rect - sats_positions
+        rho_dot_real = np.einsum('ij,ij->i', diff, -sats_speeds)/np.linalg.norm(diff, axis=1)
+        tracker.predict()
+        assert tracker.update_doppler(np.zeros(3), sats_positions, sats_speeds, rho_dot_real)
+    assert np.linalg.norm(np.degrees(tracker.state - real)) < 1e-4
+
+
 def test_doppler():
     ipoint_sph = np.array([Earth.R, radians(61.5), radians(57.5)])
     rpoint_sph = np.array([Earth.R, radians(70), radians(50)])
@@ -184,6 +690,176 @@ def test_doppler():
     assert np.linalg.norm(rpoint_sph - rpoint_sph_doppler) < 1e-3
 
 
+def test_dilution_of_precision():
+    jacobian = np.random.default_rng(0).normal(size=(10, 6, 4))
+    Q = np.linalg.inv(np.einsum('...ki,...kj->...ij', jacobian, jacobian))
+    gdop, pdop = dilution_of_precision(jacobian)
+    assert np.allclose(gdop, np.sqrt(np.trace(Q, axis1=-2, axis2=-1)))
+    assert np.allclose(pdop, np.sqrt(Q[:, 0, 0] + Q[:, 1, 1] + Q[:, 2, 2]))
+    assert np.isinf(dilution_of_precision(np.ones((3, 3)))[0])
+
+    # the first three rows leave z undetermined, an axis aligned null direction
+    degenerate = np.array([[1, 0, 0], [0, 1, 0], [1, 1, 0], [0, 0, 1], [1, 0, 1]], dtype=float)
+    assert np.all(np.isinf(dilution_of_precision(degenerate[:3])))
+    assert list(best_subset(degenerate, 3)[0]) != [0, 1, 2]
+    assert np.isfinite(best_subset(degenerate, 3)[1])
+
+    rows, score = best_subset(jacobian[0], 4)
+    assert np.isclose(score, min(dilution_of_precision(jacobian[0][list(subset)])[0]
+                                 for subset in itertools.combinations(range(6), 4)))
+
+    ipoint_sph = np.array([Earth.R, radians(61.5), radians(57.5)])
+    rpoint_rect = spherical_to_rectangular(np.array([Earth.R, radians(70), radians(50)]))
+    selector = SubsetSelector(3)
+    calls = []
+    for when in [datetime(2015, 6, 11, 20, 0, 0, 0, timezone.utc), datetime(2015, 6, 11, 20, 0, 30, 0, timezone.utc)]:
+        positions, speeds = all_constellation.states_greenwich(minutes_since_spring_equinox(when))
+        visible = np.flatnonzero(get_visible_satellites_batch(np.radians([[70, 50]]), [when])[0, 0])
+        jacobian = lambda: calls.append(when) or doppler_jacobian(spherical_to_rectangular(ipoint_sph), np.zeros(3),
+                                                                  positions[visible], speeds[visible])
+        selected, score = selector.select(visible, jacobian)
+        diff = rpoint_rect - positions[selected]
+        rho_dot_real = np.einsum('ij,ij->i', diff, -speeds[selected])/np.linalg.norm(diff, axis=-1)
+        answer = doppler(ipoint_sph, np.zeros(3), positions[selected], speeds[selected], rho_dot_real)
+        assert np.linalg.norm(np.degrees(answer[1:]) - [70, 50]) < 1e-6
+    # the visible set didn't change, the subset wasn't scored again
+    assert len(calls) == 1
+
+
+def test_doppler_least_squares():
+    ipoint_sph = np.array([Earth.R, radians(61.5), radians(57.5)])
+    rpoint_sph = np.array([Earth.R, radians(70), radians(50)])
+    when_utc = datetime(2015, 6, 11, 20, 0, 0, 0, timezone(timedelta(hours=0)))
+    minutes = minutes_since_spring_equinox(when_utc)
+
+    transit_indices, gps_indices = get_visible_satellites(rpoint_sph[1:3], when_utc)
+    selected_sats = [gps_sats[i - 1] for i in gps_indices] + [transit_sats[i - 1] for i in transit_indices]
+    assert len(selected_sats) > 3
+
+    rpoint_rect = spherical_to_rectangular(rpoint_sph)
+    sats_positions = np.array([sat.coordinates_greenwich(minutes) for sat in selected_sats])
+    sats_speeds = np.array([sat.speed_greenwich(minutes) for sat in selected_sats])
+    sats_dists = [distance(rpoint_rect, sat_pos) for sat_pos in sats_positions]
+    rho_dot_real = np.array([rho_dot(rpoint_rect, sat_pos, np.array([0, 0, 0]), sat_speed, sat_dist)
+                             for (sat_pos, sat_speed, sat_dist) in zip(sats_positions, sats_speeds, sats_dists)])
+
+    answer = doppler(ipoint_sph, np.array([0, 0, 0]), sats_positions, sats_speeds, rho_dot_real)
+    assert np.linalg.norm(rpoint_sph - answer) < 1e-3
+
+    weights = np.linspace(1, 2, len(selected_sats))
+    answer = doppler(ipoint_sph, np.array([0, 0, 0]), sats_positions, sats_speeds, rho_dot_real, weights=weights)
+    assert np.linalg.norm(rpoint_sph - answer) < 1e-3
+
+    ipoint_sph = np.array([7000, radians(69), radians(51)])
+    answer = rho_rho3(ipoint_sph, sats_positions, np.array(sats_dists), weights=weights)
+    assert np.linalg.norm(answer - np.array([Earth.R, 70, 50])) < 1e-3
+
+
+def test_doppler_stream():
+    rpoint_rect = spherical_to_rectangular(np.array([Earth.R, radians(70), radians(50)]))
+    timestamps = datetime(2015, 6, 11, 20, 0, 0, 0, timezone.utc).timestamp() + 10*np.arange(60)
+    minutes = minutes_since_spring_equinox(timestamps)
+    diff = rpoint_rect - all_constellation.coordinates_greenwich(minutes)
+    rho_dot_real = np.einsum('ijk,ijk->ij', diff, -all_constellation.speed_greenwich(minutes))
+    rho_dot_real /= np.linalg.norm(diff, axis=-1)
+    rho_dot_real[~get_visible_satellites_batch(np.radians([[70, 50]]), timestamps)[0].T] = np.nan
+
+    records = ((timestamps[k], rho_dot_real[:, k]) for k in range(len(timestamps)))
+    ipoint_sph = np.array([Earth.R, radians(61.5), radians(57.5)])
+    results = [result for _, result in doppler_stream(records, ipoint_sph, chunk_size=16)]
+    assert len(results) == len(timestamps)
+    assert all(result.converged for result in results)
+    assert all(result.iterations <= 2 for result in results[1:])
+    assert np.linalg.norm(np.degrees(results[-1].position[1:]) - np.array([70, 50])) < 1e-6
+
+    # three copies of one satellite make the Jacobian singular, those records fail without ending the stream
+    triple = Constellation.from_satellites([gps_sats[0]]*3)
+    records = [(timestamps[k], [-1, -1, -1]) for k in range(2)]
+    results = [result for _, result in doppler_stream(records, ipoint_sph, constellation=triple)]
+    assert len(results) == 2 and not any(result.converged for result in results)
+    assert np.isnan(results[0].position).all() and results[0].iterations == 0
+
+
+def test_doppler_pass():
+    rpoint_rect = spherical_to_rectangular(np.array([Earth.R, radians(70), radians(50)]))
+    minutes = minutes_since_spring_equinox(datetime(2015, 6, 11, 20, 0, 0, 0, timezone.utc)) + np.arange(20)
+    sats_positions, sats_speeds = [states.swapaxes(0, 1) for states in all_constellation.states_greenwich(minutes)]
+    diff = rpoint_rect - sats_positions
+    distances = np.linalg.norm(diff, axis=-1)
+    rho_dot_real = np.einsum('tki,tki->tk', diff, -sats_speeds) / distances
+    ipoint_sph = np.array([Earth.R + 30, radians(69.5), radians(50.5)])
+
+    # a single epoch is the doppler fix
+    assert np.allclose(doppler_pass(ipoint_sph, [0, 0, 0], sats_positions[:1], sats_speeds[:1], rho_dot_real[:1]),
+                       doppler(ipoint_sph, [0, 0, 0], sats_positions[0], sats_speeds[0], rho_dot_real[0]))
+
+    # an offset per epoch, with ranges to some of the satellites at some epochs
+    offsets = np.linspace(-0.05, 0.05, len(minutes))
+    distances[::2, :3] = np.nan
+    result, found = doppler_pass(ipoint_sph, [0, 0, 0], sats_positions, sats_speeds,
+                                 rho_dot_real + offsets[:, np.newaxis], distances, bias=True, full_output=True)
+    assert result.converged and result.residual < 1e-6
+    assert np.allclose(spherical_to_rectangular(result.position), rpoint_rect, atol=1e-6)
+    assert np.allclose(found, offsets)
+
+
+def test_service():
+    rng = np.random.default_rng(0)
+    where = np.column_stack([rng.uniform(-1.5, 1.5, 300), rng.uniform(-3, 3, 300)])
+    when = '2015-06-11T20:00:00+00:00'
+    position = np.array([7000, radians(1), radians(-1)])
+    satellites = np.array([[8639.76, -2477.41, 4383.71],
+                           [9174.33, 2287.42, -3255.68],
+                           [8974.15, -3444.85, 2756.37]])
+    distances = np.array([5141.61, 4691.28, 4656.23])
+    real = spherical_to_rectangular(np.array([Earth.R, radians(70), radians(50)]))
+    sats_positions, sats_speeds = all_constellation.states_greenwich(
+        minutes_since_spring_equinox(datetime.fromisoformat(when)))
+    rho_dot = np.einsum('ij,ij->i', real - sats_positions, -sats_speeds)/np.linalg.norm(real - sats_positions, axis=-1)
+    rho_dot[~get_visible_satellites_batch(np.radians([[70, 50]]), [datetime.fromisoformat(when)])[0, 0]] = np.nan
+
+    requests = [{'id': k, 'method': 'visible', 'params': {'where': point.tolist(), 'when': when}}
+                for k, point in enumerate(where)]
+    requests += [{'id': 'rho_rho3', 'method': 'rho_rho3', 'params': {
+        'position': position.tolist(), 'sats_cds': satellites.tolist(), 'distances': distances.tolist()}}]
+    # coalesced with the one above, its singular system must not fail it
+    requests += [{'id': 'singular', 'method': 'rho_rho3', 'params': {
+        'position': position.tolist(), 'sats_cds': [satellites[0].tolist()]*3, 'distances': distances.tolist()}}]
+    requests += [{'id': 'doppler', 'method': 'doppler', 'params': {
+        'position': [Earth.R, radians(61.5), radians(57.5)], 'when': when,
+        'rho_dot': [None if np.isnan(value) else value for value in rho_dot]}}]
+    requests += [{'id': 'bad', 'method': 'visible', 'params': {'where': [1], 'when': when}}]
+
+    async def exchange():
+        server = await Service().start(port=0)
+        reader, writer = await asyncio.open_connection(*server.sockets[0].getsockname()[:2])
+        writer.write(''.join(json.dumps(request) + '\n' for request in requests).encode())
+        responses = [json.loads(await reader.readline()) for _ in requests]
+        writer.close()
+        await writer.wait_closed()
+        server.close()
+        await server.wait_closed()
+        return {response['id']: response for response in responses}
+
+    sink = instrumentation.MetricsSink()
+    instrumentation.attach(sink)
+    try:
+        responses = asyncio.run(exchange())
+    finally:
+        instrumentation.attach(None)
+
+    visible = get_visible_satellites_batch(where, [datetime.fromisoformat(when)])[:, 0]
+    assert all(responses[k]['result'] == np.flatnonzero(visible[k]).tolist() for k in range(len(where)))
+    # a burst of requests for one epoch is solved in a few batches, not one by one
+    assert sink.snapshot()['get_visible_satellites_batch.calls'] < 10
+    assert np.allclose(responses['rho_rho3']['result']['position'], rho_rho3(np.copy(position), satellites, distances))
+    assert responses['rho_rho3']['result']['converged']
+    assert 'Singular matrix' in responses['singular']['error']
+    assert np.allclose(np.degrees(responses['doppler']['result']['position'][1:]), [70, 50])
+    assert responses['doppler']['result']['converged']
+    assert 'error' in responses['bad']
+
+
 def test_final():
     # вариант 1
     ipoint_sph = np.array([Earth.R, radians(61.5), radians(57.5)])
@@ -0,0 +1,99 @@
+import numpy as np
+from math import sin, cos
+
+from earth import Earth
+from translations import spherical_to_rectangular
+from utils import range_residuals_spherical, rho_dot_residuals
+
+
+def _as_matrix(covariance):
+    return covariance*np.eye(2) if np.ndim(covariance) == 0 else np.array(covariance, dtype=float)
+
+
+class Tracker:
+    """
+    Extended Kalman filter for an object moving on the Earth surface. The state is its [psi, lam] position in
+    radians, the prediction is state = M*state with M from get_transition_matrix. Every new set of ranges or
+    Doppler values is one linearization and a couple of 2x2 matrix operations instead of a full Newton solve.
+    """
+
+    def __init__(self, position, covariance=1e-6, transition=None, process_noise=1e-10):
+        """
+        :param position: [psi, lam] radians - initial position, e.g. a rho_rho2 fix converted to radians
+        :param covariance: radians^2 - 2x2 covariance of the initial position, or a variance for both angles
+        :param transition: 2x2 transition matrix M, identity (a standing object) if None
+        :param process_noise: radians^2 - 2x2 covariance added on every prediction, or a variance for both angles
+        """
+        self.state = np.array(position, dtype=float)
+        self.covariance = _as_matrix(covariance)
+        self.transition = np.eye(2) if transition is None else np.asarray(transition, dtype=float)
+        self.process_noise = _as_matrix(process_noise)
+
+    def predict(self):
+        """
+        :return: [psi, lam] radians - predicted position
+        """
+        self.state = self.transition.dot(self.state)
+        self.covariance = self.transition.dot(self.covariance).dot(self.transition.T) + self.process_noise
+        return self.state
+
+    def _correct(self, residuals, H, noise, gate):
+        """
+        :return: False if the normalized innovation exceeds gate and the state wasn't changed, True otherwise
+        """
+        S = H.dot(self.covariance).dot(H.T) + noise*np.eye(len(residuals))
+        if gate is not None and residuals.dot(np.linalg.solve(S, residuals)) > gate:
+            return False
+
+        K = np.linalg.solve(S, H.dot(self.covariance)).T
+        self.state = self.state + K.dot(residuals)
+        # Joseph form keeps the covariance symmetric and positive definite
+        I_KH = np.eye(2) - K.dot(H)
+        self.covariance = I_KH.dot(self.covariance).dot(I_KH.T) + noise*K.dot(K.T)
+        return True
+
+    def update_ranges(self, sats_cds, distances, noise=1e-4, gate=None, initial_covariance=1e-6):
+        """
+        :param sats_cds: [[x, y, z], ...] rectangular - visible satellites coordinates
+        :param distances: [x, ...] km - measured distances to satellites
+        :param noise: km^2 - variance of a distance measurement
+        :param gate: chi-square threshold of the normalized innovation, e.g. 9.21 for 99% and 2 satellites. When
+            the prediction is farther off, the position is re-solved with rho_rho2 and the covariance is reset
+        :param initial_covariance: radians^2 - variance the covariance is reset to after a re-solve
+        :return: True if the filter update was enough, False if the position had to be re-solved
+        """
+        sats_cds = np.asarray(sats_cds, dtype=float)
+        residuals, H = range_residuals_spherical(self.state, sats_cds, distances, np.empty_like(sats_cds),
+                                                 np.empty(len(sats_cds)), np.empty((len(sats_cds), 2)))
+        if self._correct(residuals, H, noise, gate):
+            return True
+
+        from tasks import rho_rho2
+        self.state = np.radians(rho_rho2(np.copy(self.state), sats_cds, np.asarray(distances, dtype=float)))
+        self.covariance = initial_covariance*np.eye(2)
+        return False
+
+    def update_doppler(self, speed, sats_positions, sats_speeds, doppler_values, noise=1e-6, gate=None):
+        """
+        :param speed: [xdot, ydot, zdot] - object speed
+        :param sats_positions: [[x, y, z], ...] - in greenwich coordinates
+        :param sats_speeds: [[xdot, ydot, zdot], ...] - in greenwich coordinates
+        :param doppler_values: [rhodot, ...] - measured for each satellite
+        :param noise: (km/min)^2 - variance of a rho_dot measurement
+        :param gate: chi-square threshold of the normalized innovation, the measurement is rejected above it
+        :return: True if the measurement was used, False if it was rejected by the gate
+        """
+        sats_positions = np.asarray(sats_positions, dtype=float)
+        psi, lam = self.state
+        position = spherical_to_rectangular(np.array([Earth.R, psi, lam]))
+        K = len(sats_positions)
+        residuals, H_rect = rho_dot_residuals(position, np.asarray(speed, dtype=float), sats_positions,
+                                              np.asarray(sats_speeds, dtype=float), doppler_values,
+                                              np.empty((K, 3)), np.empty((K, 3)), np.empty(K), np.empty(K),
+                                              np.empty((K, 3)))
+
+        # d[x, y, z]/d[psi, lam] on the sphere of radius Earth.R
+        d_rect = Earth.R*np.array([[-sin(psi)*cos(lam), -cos(psi)*sin(lam)],
+                                   [-sin(psi)*sin(lam),  cos(psi)*cos(lam)],
+                                   [          cos(psi),                  0]])
+        return self._correct(residuals, H_rect.dot(d_rect), noise, gate)
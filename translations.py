@@ -1,41 +1,152 @@
+import threading
+from collections import OrderedDict
 import numpy as np
 from math import sin, cos, atan2, sqrt
 
+from earth import Earth
+
+# recently used EarthRotation objects by epochs, see earth_rotation
+_rotations = OrderedDict()
+_rotations_lock = threading.Lock()
+ROTATIONS_CACHE_SIZE = 64
+# larger epoch arrays are rarely repeated, hashing and keeping them costs more than it saves
+ROTATIONS_CACHE_MAX_EPOCHS = 4096
+
+
+def _rotate_around_z(vectors, cos_gamma, sin_gamma):
+    """
+    :param vectors: numpy.array of shape (..., 3)
+    :param cos_gamma: scalar or numpy.array broadcastable against vectors[..., 0]
+    :param sin_gamma: scalar or numpy.array broadcastable against vectors[..., 0]
+    :return: numpy.array of shape (..., 3) - vectors rotated around z by angle gamma
+    """
+    vectors = np.asarray(vectors, dtype=float)
+    x, y, z = vectors[..., 0], vectors[..., 1], vectors[..., 2]
+    rotated_x = cos_gamma*x - sin_gamma*y
+    rotated_y = sin_gamma*x + cos_gamma*y
+    return np.stack(np.broadcast_arrays(rotated_x, rotated_y, z), axis=-1)
+
 
 # TODO: CHECK THE FUCKING ACCURACY. WHERE THE MINUS IS SUPPOSED TO BE?
 def greenwich_to_equatorial(greenwich, gamma):
-    matrix = np.array([[ cos(gamma),  -sin(gamma), 0],
-                       [sin(gamma),  cos(gamma), 0],
-                       [         0,           0, 1]])
-    return matrix.dot(greenwich)
+    """
+    :param greenwich: [x, y, z] numpy.array, or numpy.array of shape (N, 3)
+    :param gamma: radians - scalar, or numpy.array of shape (N,) with an angle per vector
+    :return: numpy.array of the same shape as greenwich
+    """
+    return _rotate_around_z(greenwich, np.cos(gamma), np.sin(gamma))
 
 
 # TODO: CHECK THE FUCKING ACCURACY. WHERE THE MINUS IS SUPPOSED TO BE?
 def equatorial_to_greenwich(equatorial, gamma):
-    matrix = np.array([[cos(gamma), sin(gamma), 0],
-                       [-sin(gamma),  cos(gamma), 0],
-                       [          0,          0, 1]])
-    return matrix.dot(equatorial)
+    """
+    :param equatorial: [x, y, z] numpy.array, or numpy.array of shape (N, 3)
+    :param gamma: radians - scalar, or numpy.array of shape (N,) with an angle per vector
+    :return: numpy.array of the same shape as equatorial
+    """
+    return _rotate_around_z(equatorial, np.cos(gamma), -np.sin(gamma))
+
+
+class EarthRotation:
+    """
+    cos and sin of the Earth rotation angle gamma = Earth.w_sun*minutes + Earth.w_self*minutes for a set of epochs,
+    computed once and shared by every satellite, position and speed rotated at these epochs
+    """
+
+    def __init__(self, minutes):
+        """
+        :param minutes: scalar or numpy.array - minutes since spring equinox
+        """
+        self.minutes = np.asarray(minutes, dtype=float)
+        gamma = Earth.w_sun*self.minutes + Earth.w_self*self.minutes
+        self.cos, self.sin = np.cos(gamma), np.sin(gamma)
+
+    def to_greenwich(self, equatorial):
+        """
+        :param equatorial: numpy.array of shape (..., 3), the trailing dimensions before 3 broadcast against minutes
+        :return: same as equatorial_to_greenwich(equatorial, gamma)
+        """
+        return _rotate_around_z(equatorial, self.cos, -self.sin)
+
+    def to_equatorial(self, greenwich):
+        """
+        :param greenwich: numpy.array of shape (..., 3), the trailing dimensions before 3 broadcast against minutes
+        :return: same as greenwich_to_equatorial(greenwich, gamma)
+        """
+        return _rotate_around_z(greenwich, self.cos, self.sin)
+
+    def matrices(self, to_greenwich=True):
+        """
+        :param to_greenwich: bool - equatorial to greenwich rotations if True, the inverse ones otherwise
+        :return: numpy.array of shape minutes.shape + (3, 3), one rotation matrix per epoch
+        """
+        sin_gamma = -self.sin if to_greenwich else self.sin
+        matrices = np.zeros(self.minutes.shape + (3, 3))
+        matrices[..., 0, 0] = matrices[..., 1, 1] = self.cos
+        matrices[..., 0, 1], matrices[..., 1, 0] = -sin_gamma, sin_gamma
+        matrices[..., 2, 2] = 1
+        return matrices
+
+
+def earth_rotation(minutes):
+    """
+    EarthRotation for the epochs, taken from a cache of the ROTATIONS_CACHE_SIZE most recently used ones
+    :param minutes: scalar or numpy.array - minutes since spring equinox
+    :return: EarthRotation, its arrays are read-only since they may be shared
+    """
+    minutes = np.asarray(minutes, dtype=float)
+    if minutes.size > ROTATIONS_CACHE_MAX_EPOCHS:
+        return EarthRotation(minutes)
+
+    key = (minutes.shape, minutes.tobytes())
+    with _rotations_lock:
+        rotation = _rotations.get(key)
+        if rotation is not None:
+            _rotations.move_to_end(key)
+            return rotation
+
+    rotation = EarthRotation(minutes)
+    if minutes.ndim:
+        rotation.cos.flags.writeable = rotation.sin.flags.writeable = False
+    with _rotations_lock:
+        _rotations[key] = rotation
+        if len(_rotations) > ROTATIONS_CACHE_SIZE:
+            _rotations.popitem(last=False)
+    return rotation
 
 
 def spherical_to_rectangular(spherical):
     """
-    :param spherical: numpy.array([R, psi, lam])
-    :return: numpy.array([x, y, z])
+    :param spherical: numpy.array([R, psi, lam]), or numpy.array of shape (N, 3) with a point per row
+    :return: numpy.array([x, y, z]), or numpy.array of shape (N, 3)
     """
-    R, psi, lam = spherical
-    return R*np.array([cos(psi)*cos(lam),
-                       cos(psi)*sin(lam),
-                       sin(psi)])
+    spherical = np.asarray(spherical, dtype=float)
+    if spherical.ndim == 1:
+        R, psi, lam = spherical
+        return R*np.array([cos(psi)*cos(lam),
+                           cos(psi)*sin(lam),
+                           sin(psi)])
+
+    R, psi, lam = spherical[..., 0, np.newaxis], spherical[..., 1], spherical[..., 2]
+    return R*np.stack([np.cos(psi)*np.cos(lam),
+                       np.cos(psi)*np.sin(lam),
+                       np.sin(psi)], axis=-1)
 
 
 def rectangular_to_spherical(rectangular):
     """
-    :param rectangular: numpy.array([x, y, z])
-    :return: numpy.array([R, psi, lam])
+    :param rectangular: numpy.array([x, y, z]), or numpy.array of shape (N, 3) with a point per row
+    :return: numpy.array([R, psi, lam]), or numpy.array of shape (N, 3)
     """
-    x, y, z = rectangular
-    R = np.linalg.norm([x, y, z])
-    psi = atan2(z, sqrt(x**2 + y**2))
-    lam = atan2(y, x)
-    return np.array([R, psi, lam])
+    rectangular = np.asarray(rectangular, dtype=float)
+    if rectangular.ndim == 1:
+        x, y, z = rectangular
+        R = np.linalg.norm([x, y, z])
+        psi = atan2(z, sqrt(x**2 + y**2))
+        lam = atan2(y, x)
+        return np.array([R, psi, lam])
+
+    x, y, z = rectangular[..., 0], rectangular[..., 1], rectangular[..., 2]
+    return np.stack([np.sqrt(x**2 + y**2 + z**2),
+                     np.arctan2(z, np.hypot(x, y)),
+                     np.arctan2(y, x)], axis=-1)
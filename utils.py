@@ -1,18 +1,97 @@
 from math import sin, cos
+from datetime import datetime, timezone
 import numpy as np
-from earth import *
-from translations import *
+from earth import Earth
+from translations import spherical_to_rectangular
+
+def _to_datetime64(when):
+    """
+    :param when: datetime.datetime (naive ones are taken as UTC), sequence of them, numpy.datetime64 array in UTC
+        or POSIX timestamps array in seconds
+    :return: numpy.datetime64[us] scalar or array in UTC
+    """
+    if isinstance(when, datetime):
+        if when.tzinfo is not None:
+            when = when.astimezone(timezone.utc).replace(tzinfo=None)
+        return np.datetime64(when, 'us')
+
+    when = np.asarray(when)
+    if when.dtype == object:
+        return np.array([_to_datetime64(moment) for moment in when.ravel()]).reshape(when.shape)
+    if np.issubdtype(when.dtype, np.datetime64):
+        return when.astype('datetime64[us]')
+    return np.round(when*1e6).astype(np.int64).astype('datetime64[us]')
+
 
 def minutes_since_spring_equinox(when):
     """
-    :param when: datetime.datetime object in UTC timezone
-    :return: Number of minutes passed since spring equinox
+    :param when: datetime.datetime object in UTC timezone, or an array of times, see _to_datetime64
+    :return: Number of minutes passed since spring equinox (March 22, 00:00 UTC), fractional, numpy.array for arrays
+    """
+    when = _to_datetime64(when)
+
+    year = when.astype('datetime64[Y]')
+    equinox = (year.astype('datetime64[M]') + 2).astype('datetime64[D]') + 21
+    # before March 22 minutes are counted from the previous year equinox, leap days included
+    previous_equinox = ((year - 1).astype('datetime64[M]') + 2).astype('datetime64[D]') + 21
+    equinox = np.where(when < equinox, previous_equinox, equinox)
+
+    return (when - equinox) / np.timedelta64(1, 'm')
+
+
+class GroundStation:
+    """
+    Observers fixed to the Earth, with everything about them that doesn't change with time computed once.
+    Accepted in place of rectangular positions by the visibility functions below, distance and
+    get_visible_satellites(_batch), for stations queried over and over again.
     """
-    b = [0, 31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30]
-    days = (sum(b[0:when.month]) + when.day - 81) % 365
-    hours = when.hour % 24
-    minutes = when.minute
-    return days*1440 + hours*60 + minutes
+
+    __slots__ = ('spherical', 'position', 'norm2', 'norm', 'normal', 'horizon', 'enu')
+
+    def __init__(self, where):
+        """
+        :param where: [psi, lam] radians on the Earth surface or [R, psi, lam] km radians, or numpy.array of shape
+            (M, 2) or (M, 3) of them for M stations
+        """
+        where = np.array(where, dtype=float)
+        if where.shape[-1] == 2:
+            where = np.insert(where, 0, Earth.R, axis=-1)
+        psi, lam = where[..., 1], where[..., 2]
+
+        self.spherical = where
+        self.position = spherical_to_rectangular(where)
+        self.norm2 = np.einsum('...i,...i->...', self.position, self.position)
+        self.norm = np.sqrt(self.norm2)
+        self.normal = self.position / self.norm[..., np.newaxis]
+        # right side of the sat_really_visible criterion, the only part depending on the position alone
+        self.horizon = - np.sqrt(np.maximum(0, 1 - Earth.R ** 2 / self.norm2))
+        # rows are the local east, north and up directions in greenwich coordinates
+        self.enu = np.stack([np.stack([-np.sin(lam), np.cos(lam), np.zeros_like(lam)], axis=-1),
+                             np.stack([-np.sin(psi)*np.cos(lam), -np.sin(psi)*np.sin(lam), np.cos(psi)], axis=-1),
+                             self.normal], axis=-2)
+
+    def distances(self, sats_cds):
+        """
+        :param sats_cds: numpy.array of shape (..., K, 3) - satellites greenwich coordinates
+        :return: numpy.array of shape (..., K) - distances from the stations to the satellites
+        """
+        return np.linalg.norm(self.position[..., np.newaxis, :] - sats_cds, axis=-1)
+
+    def range_rates(self, sats_positions, sats_speeds):
+        """
+        :param sats_positions: numpy.array of shape (..., K, 3) - satellites greenwich coordinates
+        :param sats_speeds: numpy.array of shape (..., K, 3) - satellites greenwich speeds
+        :return: numpy.array of shape (..., K) - rho_dot of the satellites, the stations don't move in greenwich
+        """
+        diff = self.position[..., np.newaxis, :] - sats_positions
+        return - np.einsum('...i,...i->...', diff, sats_speeds) / np.linalg.norm(diff, axis=-1)
+
+    def to_enu(self, sats_cds):
+        """
+        :param sats_cds: numpy.array of shape (..., K, 3) - satellites greenwich coordinates
+        :return: numpy.array of shape (..., K, 3) - [east, north, up] of the satellites relative to the stations
+        """
+        return np.einsum('...ij,...kj->...ki', self.enu, sats_cds - self.position[..., np.newaxis, :])
 
 
 def sat_visible(position, satellite):
@@ -26,31 +105,81 @@ def sat_visible(position, satellite):
 
 def sat_really_visible(position, satellite):
     """
-    :param position: [x, y, z] numpy.array with position rectangular coordinates
+    :param position: [x, y, z] numpy.array with position rectangular coordinates, or a GroundStation
     :param satellite: [x, y, z] numpy.array with satellite rectangular coordinates
     :return: True if the satellite is visible from current position
     """
+    if isinstance(position, GroundStation):
+        position, right = position.position, position.horizon
+    else:
+        # clipped: for a point right on the surface rounding can make it slightly negative, sqrt would give nan
+        right = - np.sqrt(max(0, 1 - Earth.R ** 2 / np.linalg.norm(position) ** 2))
     left = position.dot(satellite - position)/(np.linalg.norm(satellite) * np.linalg.norm(satellite - position))
-    right = - np.sqrt(1 - Earth.R ** 2 / np.linalg.norm(position) ** 2)
     # TODO: check for accuracy
     return left > right
 
 
+def sats_really_visible(positions, satellites):
+    """
+    Same criterion as sat_really_visible, for every pair of position and satellite at once
+    :param positions: numpy.array of shape (M, 3) with positions rectangular coordinates, or a GroundStation of M
+        stations (M = 1 for a single one)
+    :param satellites: numpy.array of shape (..., 3) with satellites rectangular coordinates
+    :return: bool numpy.array of shape (M, ...), True where the satellite is visible from the position
+    """
+    satellites = np.asarray(satellites, dtype=float)
+    per_position = (-1,) + (1,)*(satellites.ndim - 1)
+    if isinstance(positions, GroundStation):
+        pos_norm2, right = positions.norm2.reshape(per_position), positions.horizon.reshape(per_position)
+        positions = positions.position.reshape(-1, 3)
+    else:
+        positions = np.asarray(positions, dtype=float)
+        pos_norm2 = np.einsum('ij,ij->i', positions, positions).reshape(per_position)
+        right = - np.sqrt(np.maximum(0, 1 - Earth.R ** 2 / pos_norm2))
+
+    # |s - p|^2 = |s|^2 - 2 p.s + |p|^2, so the only (M, ...) sized product is p.s
+    sat_norm2 = np.einsum('...i,...i->...', satellites, satellites)
+    dot = np.tensordot(positions, satellites, axes=([1], [-1]))
+
+    left = (dot - pos_norm2)/np.sqrt(sat_norm2*np.maximum(sat_norm2 - 2*dot + pos_norm2, 0))
+    return left > right
+
+
+def visibility_margin(positions, satellites):
+    """
+    left - right of the sat_really_visible criterion, positive where the satellite is visible, elementwise
+    :param positions: numpy.array of shape (..., 3) with positions rectangular coordinates, or a GroundStation
+    :param satellites: numpy.array of shape (..., 3) with satellites rectangular coordinates, broadcast with positions
+    :return: numpy.array of shape (...) - continuous in time, so horizon crossings are its roots
+    """
+    if isinstance(positions, GroundStation):
+        positions, right = positions.position, positions.horizon
+    else:
+        right = - np.sqrt(np.maximum(0, 1 - Earth.R ** 2 / np.einsum('...i,...i->...', positions, positions)))
+    diff = satellites - positions
+    left = np.einsum('...i,...i->...', positions, diff) / \
+        (np.linalg.norm(satellites, axis=-1) * np.linalg.norm(diff, axis=-1))
+    return left - right
+
+
 def distance(position, satellite):
     """
-    :param position: [x, y, z] numpy.array with position rectangular coordinates
+    :param position: [x, y, z] numpy.array with position rectangular coordinates, or a GroundStation
     :param satellite: [x, y, z] numpy.array with satellite rectangular coordinates
     :return: int distance between them in Euclidean metric
     """
+    if isinstance(position, GroundStation):
+        position = position.position
     return np.linalg.norm(position-satellite)
 
 
-def distance_derivative(position, satellite, distance, spherical):
+def distance_derivative(position, satellite, distance, spherical, rectangular=None):
     """
     :param position: [R, psi, lam] if spherical==True, [x, y, z] otherwise
     :param satellite: [x, y, z] numpy.array with satellite rectangular coordinates
     :param distance: int distance between them in Euclidean metric
     :param spherical: bool specifying the type of position coordinates
+    :param rectangular: [x, y, z] of the spherical position if the caller already has them
     :return: either [dq/dpsi, qd/dlam] numpy.array if spherical==True, or [dq/dx, dq/dy, dq/dz] otherwise
     """
     if spherical:
@@ -62,7 +191,7 @@ def distance_derivative(position, satellite, distance, spherical):
         # dq_dpsi = R/distance * (x*sin(psi)*cos(lam) + y*sin(psi)*sin(lam) - z*cos(psi))
         # dq_dlam = R/distance * cos(psi)*(x*sin(lam) - y*cos(lam))
 
-        x, y, z = spherical_to_rectangular(position)
+        x, y, z = spherical_to_rectangular(position) if rectangular is None else rectangular
         xs, ys, zs = satellite
         dq_dpsi = R/distance * ((xs-x)*sin(psi)*cos(lam) + (ys-y)*sin(psi)*sin(lam) - (zs-z)*cos(psi))
         dq_dlam = R/distance * cos(psi)*((xs-x)*sin(lam) - (ys-y)*cos(lam))
@@ -77,5 +206,141 @@ def rho_dot(position, sat_position, speed, sat_speed, dist):
 
 
 def rho_dot_derivative(position, sat_position, speed, sat_speed, dist):
-    args = [position, sat_position, speed, sat_speed, dist]
-    return (speed-sat_speed)/dist - rho_dot(*args)*(position-sat_position)/(dist**2)
+    diff, speed_diff = position-sat_position, speed-sat_speed
+    return speed_diff/dist - diff.dot(speed_diff)*diff/(dist**3)
+
+
+# Fused kernels below evaluate the residuals (measured - computed) and the whole Jacobian for all satellites at once.
+# They write into caller-provided buffers, so a solver allocates them once and reuses them on every iteration.
+# Leading dimensions (...) allow solving a stack of independent fixes with the same call.
+
+def range_residuals(position, sats_cds, measured, diff, residuals, jacobian):
+    """
+    :param position: numpy.array of shape (..., 3) - [x, y, z] approximate position
+    :param sats_cds: numpy.array of shape (..., K, 3) - satellites rectangular coordinates
+    :param measured: numpy.array of shape (..., K) - measured distances
+    :param diff: buffer of shape (..., K, 3), receives position - satellite
+    :param residuals: buffer of shape (..., K), receives measured - computed distances
+    :param jacobian: buffer of shape (..., K, 3), receives [dq/dx, dq/dy, dq/dz] rows
+    :return: (residuals, jacobian)
+    """
+    np.subtract(position[..., np.newaxis, :], sats_cds, out=diff)
+    np.einsum('...i,...i->...', diff, diff, out=residuals)
+    np.sqrt(residuals, out=residuals)
+    np.divide(diff, residuals[..., np.newaxis], out=jacobian)
+    np.subtract(measured, residuals, out=residuals)
+    return residuals, jacobian
+
+
+def range_residuals_spherical(pos_sph2, sats_cds, measured, diff, residuals, jacobian, R=Earth.R):
+    """
+    :param pos_sph2: numpy.array of shape (..., 2) - [psi, lam] radians approximate position at radius R
+    :param sats_cds: numpy.array of shape (..., K, 3) - satellites rectangular coordinates
+    :param measured: numpy.array of shape (..., K) - measured distances
+    :param diff: buffer of shape (..., K, 3), receives satellite - position
+    :param residuals: buffer of shape (..., K), receives measured - computed distances
+    :param jacobian: buffer of shape (..., K, 2), receives [dq/dpsi, dq/dlam] rows
+    :param R: km - position radius
+    :return: (residuals, jacobian)
+    """
+    psi, lam = pos_sph2[..., 0], pos_sph2[..., 1]
+    cos_psi, sin_psi, cos_lam, sin_lam = np.cos(psi), np.sin(psi), np.cos(lam), np.sin(lam)
+    zero = np.zeros_like(cos_psi)
+
+    # position, then both columns of distance_derivative(spherical=True) as projections of satellite - position
+    position = R*np.stack([cos_psi*cos_lam, cos_psi*sin_lam, sin_psi], axis=-1)
+    projections = np.stack([np.stack([sin_psi*cos_lam, sin_psi*sin_lam, -cos_psi], axis=-1),
+                            np.stack([cos_psi*sin_lam, -cos_psi*cos_lam, zero], axis=-1)], axis=-1)
+
+    np.subtract(sats_cds, position[..., np.newaxis, :], out=diff)
+    np.einsum('...i,...i->...', diff, diff, out=residuals)
+    np.sqrt(residuals, out=residuals)
+    np.matmul(diff, projections, out=jacobian)
+    jacobian *= R
+    jacobian /= residuals[..., np.newaxis]
+    np.subtract(measured, residuals, out=residuals)
+    return residuals, jacobian
+
+
+def rho_dot_residuals(position, speed, sats_positions, sats_speeds, measured,
+                      diff, speed_diff, dists, residuals, jacobian):
+    """
+    :param position: numpy.array of shape (..., 3) - [x, y, z] approximate position
+    :param speed: numpy.array of shape (..., 3) - [xdot, ydot, zdot] position speed
+    :param sats_positions: numpy.array of shape (..., K, 3) - satellites rectangular coordinates
+    :param sats_speeds: numpy.array of shape (..., K, 3) - satellites speeds
+    :param measured: numpy.array of shape (..., K) - measured rho_dot values
+    :param diff: buffer of shape (..., K, 3), receives position - satellite
+    :param speed_diff: buffer of shape (..., K, 3), receives speed - satellite speed
+    :param dists: buffer of shape (..., K), receives distances to satellites
+    :param residuals: buffer of shape (..., K), receives measured - computed rho_dot
+    :param jacobian: buffer of shape (..., K, 3), receives rho_dot_derivative rows
+    :return: (residuals, jacobian)
+    """
+    np.subtract(position[..., np.newaxis, :], sats_positions, out=diff)
+    np.subtract(speed[..., np.newaxis, :], sats_speeds, out=speed_diff)
+    np.einsum('...i,...i->...', diff, diff, out=dists)
+    np.sqrt(dists, out=dists)
+
+    # residuals temporarily hold rho_dot/dist, shared by the Jacobian and by rho_dot itself
+    np.einsum('...i,...i->...', diff, speed_diff, out=residuals)
+    residuals /= dists
+    residuals /= dists
+    np.multiply(diff, residuals[..., np.newaxis], out=jacobian)
+    np.subtract(speed_diff, jacobian, out=jacobian)
+    jacobian /= dists[..., np.newaxis]
+
+    residuals *= dists
+    np.subtract(measured, residuals, out=residuals)
+    return residuals, jacobian
+
+
+def least_squares_step(A, b, weights=None):
+    """
+    Solves the linearized system A*dq = b, in the least squares sense when there are more equations than unknowns
+    :param A: numpy.array of shape (..., K, n), K >= n - Jacobian, a row per measurement
+    :param b: numpy.array of shape (..., K) - measured minus computed values
+    :param weights: numpy.array of shape (..., K) - measurement weights, equal weights if None
+    :return: numpy.array of shape (..., n) - dq minimizing sum(weights*(A*dq - b)**2)
+    """
+    A = np.asarray(A, dtype=float)
+    b = np.asarray(b, dtype=float)
+    if weights is None and A.shape[-2] == A.shape[-1]:
+        return np.linalg.solve(A, b[..., np.newaxis])[..., 0]
+
+    if weights is not None:
+        sqrt_weights = np.sqrt(np.asarray(weights, dtype=float))
+        A = A*sqrt_weights[..., np.newaxis]
+        b = b*sqrt_weights
+
+    # A = QR, so A^T A dq = A^T b turns into R dq = Q^T b without squaring the condition number
+    q, r = np.linalg.qr(A)
+    return np.linalg.solve(r, np.einsum('...ki,...k->...i', q, b)[..., np.newaxis])[..., 0]
+
+
+def least_squares_steps(A, b, weights=None):
+    """
+    least_squares_step for a stack of N independent systems, where a singular one doesn't fail the others
+    :param A: numpy.array of shape (N, K, n) - Jacobians
+    :param b: numpy.array of shape (N, K) - measured minus computed values
+    :param weights: numpy.array of shape (N, K) - measurement weights, equal weights if None
+    :return: (numpy.array of shape (N, n) - steps, nan for singular systems, bool numpy.array of shape (N,) - True
+        for singular systems)
+    """
+    try:
+        dq = least_squares_step(A, b, weights)
+        return dq, np.zeros(len(dq), dtype=bool)
+    except np.linalg.LinAlgError:
+        pass
+
+    # numpy doesn't tell which one of the stack is singular: a rank deficient system has a (numerically) zero
+    # diagonal element of R in its QR, the rest are solved together in one more stacked call
+    A = np.asarray(A, dtype=float)
+    weighted = A if weights is None else A*np.sqrt(np.asarray(weights, dtype=float))[..., np.newaxis]
+    diagonal = np.abs(np.diagonal(np.linalg.qr(weighted, mode='r'), axis1=-2, axis2=-1))
+    singular = diagonal.min(axis=-1) <= diagonal.max(axis=-1)*max(A.shape[-2:])*np.finfo(float).eps
+    dq = np.full(A.shape[:1] + A.shape[-1:], np.nan)
+    regular = ~singular
+    dq[regular] = least_squares_step(A[regular], np.asarray(b)[regular], None if weights is None else
+                                     np.asarray(weights)[regular])
+    return dq, singular